@@ -0,0 +1,47 @@
+import os
+import zlib
+import numpy as np
+
+DEFAULT_RESAMPLES = 1000
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_SEED = 0
+MAX_CHUNK_ELEMENTS = 1 << 22  # Resampled bin counts held at a time (32 MB of int64)
+
+
+def image_rng(file_name, seed = DEFAULT_SEED):
+    # Random generator of one image, seeded from its file name, so its interval does not depend on
+    # which other images are analyzed with it (or skipped as unchanged), nor on the GUI or CLI path
+    return np.random.default_rng([seed, zlib.crc32(os.path.basename(file_name).encode())])
+
+
+def bootstrap_means(histogram, resamples, rng, max_chunk_elements = MAX_CHUNK_ELEMENTS):
+    # (resamples,) bootstrap means of a non-empty ROIHistogram. Resampling the ROI's n pixels with
+    # replacement is a multinomial draw of n over its intensity bins, so the cost does not depend on
+    # the ROI area, only on the number of non-empty bins.
+    values, counts = histogram.values_and_counts()
+    total = counts.sum()
+    probabilities = counts / total
+    means = np.empty(resamples)
+    chunk = max(1, max_chunk_elements // len(values))
+    for start in range(0, resamples, chunk):
+        size = min(chunk, resamples - start)
+        means[start:start + size] = rng.multinomial(total, probabilities, size=size) @ values / total
+    return means
+
+
+def ratio_interval(liver_histogram, kidney_histogram, resamples = DEFAULT_RESAMPLES, confidence = DEFAULT_CONFIDENCE,
+                   rng = None, max_chunk_elements = MAX_CHUNK_ELEMENTS):
+    # Percentile bootstrap interval (low, high) of the hepatic-renal ratio of one image, from its liver
+    # and kidney ROIHistograms; (None, None) if either is empty
+    if (liver_histogram is None or kidney_histogram is None or liver_histogram.count == 0
+            or kidney_histogram.sum == 0 or resamples <= 0):
+        return None, None
+    if rng is None:
+        rng = np.random.default_rng(DEFAULT_SEED)
+    liver_means = bootstrap_means(liver_histogram, resamples, rng, max_chunk_elements)
+    kidney_means = bootstrap_means(kidney_histogram, resamples, rng, max_chunk_elements)
+    with np.errstate(divide="ignore"):
+        ratios = liver_means / kidney_means
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.percentile(ratios, [tail, 100 - tail])
+    return float(low), float(high)
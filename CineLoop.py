@@ -0,0 +1,52 @@
+import numpy as np
+
+DEFAULT_MAX_FRAMES_IN_MEMORY = 32
+
+
+def _memory_map(file_name):
+    # (frames, height, width) uint8 memory map of an uncompressed grayscale TIFF stack, or None.
+    # Other layouts (compressed, color, 16-bit) are decoded by OpenCV, so values match cv2.IMREAD_GRAYSCALE.
+    try:
+        import tifffile  # Optional, imported on the first multi-frame read rather than at startup
+    except ImportError:
+        return None
+    try:
+        with tifffile.TiffFile(file_name) as tif:
+            page = tif.pages[0]
+            # One sample per pixel, and no axis other than the frames before the image rows and columns
+            # (an RGB image is (height, width, 3), which would otherwise pass as height frames)
+            if (page.samplesperpixel != 1 or page.photometric != tifffile.PHOTOMETRIC.MINISBLACK
+                    or not tif.series[0].axes.endswith("YX") or len(tif.series[0].axes) > 3):
+                return None
+        stack = tifffile.memmap(file_name, mode="r")
+    except Exception:
+        return None
+    if stack.dtype != np.uint8 or stack.ndim not in (2, 3):
+        return None
+    return stack[np.newaxis] if stack.ndim == 2 else stack
+
+
+def iter_frame_chunks(file_name, max_frames_in_memory = DEFAULT_MAX_FRAMES_IN_MEMORY):
+    # Yields (first frame index, (frames, height, width) grayscale uint8 stack) in chunks,
+    # so at most max_frames_in_memory decoded frames are held at a time
+    import cv2
+    stack = _memory_map(file_name)
+    frame_count = len(stack) if stack is not None else cv2.imcount(file_name)
+    if frame_count == 0:
+        raise FileNotFoundError(f"Image file '{file_name}' not found.")
+    for start in range(0, frame_count, max_frames_in_memory):
+        count = min(max_frames_in_memory, frame_count - start)
+        if stack is not None:
+            yield start, stack[start:start + count]
+            continue
+        success, frames = cv2.imreadmulti(file_name, start, count, flags=cv2.IMREAD_GRAYSCALE)
+        if not success:
+            raise IOError(f"Could not read frames {start}-{start + count - 1} of '{file_name}'.")
+        yield start, np.stack(frames)
+
+
+def frame_means(chunk, indices):
+    # Per-frame mean of the pixels at the flat indices (NaN if there are none), for a whole chunk at once
+    if len(indices) == 0:
+        return np.full(len(chunk), np.nan)
+    return chunk.reshape(len(chunk), -1)[:, indices].mean(axis=1, dtype=np.float64)
@@ -0,0 +1,142 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_BUDGET_MB = int(os.environ.get("HRR_IMAGE_CACHE_MB", 512))
+MAX_SCALED_VIEWS = 3  # Display sizes kept per image
+
+
+def _bgr_to_gray(image):
+    # Same fixed-point weights and rounding cv2.imread(..., IMREAD_GRAYSCALE) uses for TIFF files,
+    # so the grayscale view is identical to decoding the file again in grayscale
+    image = image.astype(np.int32)
+    gray = image[..., 0] * 1868 + image[..., 1] * 9617 + image[..., 2] * 4899 + (1 << 13)
+    return (gray >> 14).astype(np.uint8)
+
+
+class DecodedImageCache:
+    # Process-wide cache of decoded images, keyed by path + modification time.
+    # Files are decoded once: the scaled display views and, when the image is on screen, the grayscale
+    # analysis view are derived from the RGB decode; images only analyzed are decoded straight to grayscale.
+    # Least recently used images are evicted beyond the memory budget, a budget of 0 disables caching.
+    def __init__(self, budget_mb = DEFAULT_BUDGET_MB):
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self._entries = OrderedDict()  # key -> {view name: read-only array}
+        self._lock = threading.Lock()
+        self.used_bytes = 0
+
+    @staticmethod
+    def _key(path):
+        try:
+            return os.path.abspath(path), os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def set_budget(self, budget_mb):
+        with self._lock:
+            self.budget_bytes = int(budget_mb * 1024 * 1024)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.used_bytes = 0
+
+    def _evict(self, keep = None):
+        while self.used_bytes > self.budget_bytes and self._entries:
+            key = next(iter(self._entries))
+            if key == keep:
+                if len(self._entries) == 1:
+                    break
+                self._entries.move_to_end(key)
+                continue
+            entry = self._entries.pop(key)
+            self.used_bytes -= sum(view.nbytes for view in entry.values())
+
+    def _store(self, key, name, view):
+        view.setflags(write=False)  # Shared between callers, never modify in place
+        if self.budget_bytes <= 0:
+            return view
+        with self._lock:
+            entry = self._entries.setdefault(key, {})
+            if name not in entry:
+                entry[name] = view
+                self.used_bytes += view.nbytes
+            self._entries.move_to_end(key)
+            view = entry[name]
+            self._evict(keep = key)
+        return view
+
+    def _lookup(self, key, name):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or name not in entry:
+                return None
+            self._entries.move_to_end(key)
+            return entry[name]
+
+    def get_rgb(self, path):
+        # RGB uint8 image, or None if the file cannot be read
+        key = self._key(path)
+        if key is None:
+            return None
+        rgb = self._lookup(key, "rgb")
+        if rgb is None:
+            import cv2  # Loaded on the first decode, not at startup
+            bgr = cv2.imread(path, cv2.IMREAD_COLOR)
+            if bgr is None:
+                return None
+            rgb = self._store(key, "rgb", cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
+        return rgb
+
+    def get_gray(self, path):
+        # Grayscale uint8 image (as cv2.IMREAD_GRAYSCALE), or None if the file cannot be read
+        key = self._key(path)
+        if key is None:
+            return None
+        gray = self._lookup(key, "gray")
+        if gray is None:
+            rgb = self._lookup(key, "rgb")
+            if rgb is not None:
+                gray = _bgr_to_gray(rgb[..., ::-1])
+            else:
+                import cv2
+                gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+                if gray is None:
+                    return None
+            gray = self._store(key, "gray", gray)
+        return gray
+
+    def get_scaled(self, path, size, high_quality = True):
+        # RGB image resized to size (width, height) for display, or None if the file cannot be read.
+        # High quality (LANCZOS) results are cached per size; the fast (NEAREST) resize used
+        # while the window is being resized is cheap enough to be recomputed.
+        from PIL import Image
+        key = self._key(path)
+        if key is None:
+            return None
+        name = ("scaled", tuple(size))
+        scaled = self._lookup(key, name)  # A cached (e.g. prefetched) high quality resize is always preferred
+        if scaled is None:
+            rgb = self.get_rgb(path)
+            if rgb is None:
+                return None
+            resample = Image.Resampling.LANCZOS if high_quality else Image.Resampling.NEAREST
+            scaled = np.asarray(Image.fromarray(rgb).resize(tuple(size), resample))
+            if high_quality:
+                self._drop_scaled_views(key)
+                scaled = self._store(key, name, scaled)
+        return scaled
+
+    def _drop_scaled_views(self, key):
+        # Keeps at most MAX_SCALED_VIEWS - 1 display sizes, so a new one can be added
+        with self._lock:
+            entry = self._entries.get(key, {})
+            scaled_names = [name for name in entry if isinstance(name, tuple)]
+            for name in scaled_names[:max(0, len(scaled_names) - MAX_SCALED_VIEWS + 1)]:
+                self.used_bytes -= entry.pop(name).nbytes
+
+
+# Shared by HepaticRenalRatioImage, HepaticRenalRatioAnalyzer and HepaticRenalRatioApp
+image_cache = DecodedImageCache()
@@ -3,9 +3,18 @@ import tkinter as tk
 from tkinter import Canvas
 from tkinter import messagebox
 from HepaticRenalRatioImage import HepaticRenalRatioImage
-import cv2
+from DecodedImageCache import image_cache
+from LiveROIStatistics import LiveROIStatistics
+from ROIStatistics import flag_outliers
 from PIL import Image, ImageTk
 
+# Delay (ms) after the last resize event before the image is redrawn in high quality
+RESIZE_IDLE_DELAY = 200
+CIRCLE_COLORS = {"Liver": "blue", "Kidney": "yellow"}
+# ROIs whose mean is an outlier among the ROIs of their organ (see ROIStatistics.flag_outliers)
+OUTLIER_COLOR = "red"
+OUTLIER_DASH = (6, 4)
+
 class HepaticRenalRatioAnalyzer():
     def __init__(self, hrr_image: HepaticRenalRatioImage, single_image_analysis=True,root = None):
         self.hrr_image = hrr_image
@@ -14,11 +23,17 @@ class HepaticRenalRatioAnalyzer():
         self.circles = {"Liver": self.hrr_image.liver_locations, "Kidney": self.hrr_image.kidney_locations}
 
         # Load and resize image for display
-        self.image = cv2.imread(self.hrr_image.file_name)
+        self.image = image_cache.get_rgb(self.hrr_image.file_name)
         if self.image is None:
             raise FileNotFoundError(f"Image file '{self.hrr_image.file_name}' not found.")
-        self.image = cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB)
-        self.display_image = Image.fromarray(self.image)
+
+        # Canvas items are created once and updated in place
+        self.image_item = None
+        self.displayed_size = None  # (width, height, high_quality) of the image currently shown
+        self.circle_items = {"Liver": [], "Kidney": []}
+        self.resize_job = None
+        self.live_statistics = None  # LiveROIStatistics, built on first use
+        self.outliers = {"Liver": [], "Kidney": []}  # Outlier flag of every circle
 
         # Initialize GUI
         if root is None:
@@ -44,11 +59,14 @@ class HepaticRenalRatioAnalyzer():
         self.canvas.bind("<ButtonRelease-1>", self.complete_circle)
         self.canvas.bind("<Button-3>", self.remove_circle)
 
-        self.canvas.bind("<Configure>", lambda event: self.update_image())
+        self.canvas.bind("<Configure>", self.on_resize)
+        # The app destroys the canvas when another image is selected, a pending redraw must not run after that
+        self.canvas.bind("<Destroy>", self.on_destroy)
 
 
         self.start_x = self.start_y = None
         self.current_circle = None
+        self.show_stored_statistics()
         if self.root is None:
             self.root.bind_all("<space>", self.toggle_mode)
             self.root.mainloop()
@@ -68,11 +86,32 @@ class HepaticRenalRatioAnalyzer():
             self.analyze_button = tk.Button(self.menu_frame, text="Analyze", font=("Arial", 14), command=self.analyze)
             self.analyze_button.pack(side=tk.RIGHT, padx=20)
 
+        # Live liver mean, kidney mean and HRR of the ROIs on screen (including the one being drawn)
+        self.live_label = tk.Label(self.menu_frame, text="", bg="lightgray", font=("Arial", 12))
+        self.live_label.pack(side=tk.RIGHT, padx=20)
+
     def toggle_mode(self, event=None):
         self.current_mode = "Kidney" if self.current_mode == "Liver" else "Liver"
         self.mode_label.config(text=f"Mode: {self.current_mode}")
 
-    def update_image(self):
+    def on_resize(self, event=None):
+        # While the window is being resized, redraw with a fast resampler and
+        # only redraw in high quality once no resize event arrived for RESIZE_IDLE_DELAY ms
+        if self.resize_job is not None:
+            self.canvas.after_cancel(self.resize_job)
+        self.update_image(high_quality=False)
+        self.resize_job = self.canvas.after(RESIZE_IDLE_DELAY, self.on_resize_idle)
+
+    def on_destroy(self, event=None):
+        if self.resize_job is not None:
+            self.canvas.after_cancel(self.resize_job)
+            self.resize_job = None
+
+    def on_resize_idle(self):
+        self.resize_job = None
+        self.update_image()
+
+    def update_image(self, high_quality=True):
         # Get canvas dimensions
         canvas_width = self.canvas.winfo_width() or self.root.winfo_width()
         canvas_height = self.canvas.winfo_height() or self.root.winfo_height()
@@ -81,14 +120,21 @@ class HepaticRenalRatioAnalyzer():
         self.scale_x = canvas_width / self.image.shape[1]
         self.scale_y = canvas_height / self.image.shape[0]
 
-        # Resize the image to fit the canvas
-        resized_width = int(self.image.shape[1] * self.scale_x)
-        resized_height = int(self.image.shape[0] * self.scale_y)
-        self.resized_image = self.display_image.resize((resized_width, resized_height), Image.Resampling.LANCZOS)
-
-        # Display the resized image
-        self.tk_image = ImageTk.PhotoImage(self.resized_image)
-        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image)
+        # Resize the image to fit the canvas (high quality resizes are cached per canvas size). The canvas size
+        # is used as is, rather than image size * scale, so it matches the size the prefetcher was given exactly
+        resized_width, resized_height = canvas_width, canvas_height
+        shown = self.displayed_size
+        if shown is None or shown[:2] != (resized_width, resized_height) or (high_quality and not shown[2]):
+            scaled = image_cache.get_scaled(self.hrr_image.file_name, (resized_width, resized_height), high_quality)
+            if scaled is not None:
+                self.resized_image = Image.fromarray(scaled)
+                self.tk_image = ImageTk.PhotoImage(self.resized_image)
+                if self.image_item is None:
+                    self.image_item = self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image)
+                    self.canvas.tag_lower(self.image_item)
+                else:
+                    self.canvas.itemconfig(self.image_item, image=self.tk_image)
+                self.displayed_size = (resized_width, resized_height, high_quality)
 
         self.redraw_circles()
 
@@ -96,7 +142,7 @@ class HepaticRenalRatioAnalyzer():
         self.start_x, self.start_y = event.x, event.y
         self.current_circle = self.canvas.create_oval(
             self.start_x, self.start_y, self.start_x, self.start_y,
-            outline="blue" if self.current_mode == "Liver" else "yellow",
+            outline=CIRCLE_COLORS[self.current_mode],
             fill="",
             width=2
         )
@@ -107,24 +153,27 @@ class HepaticRenalRatioAnalyzer():
                 self.current_circle,
                 self.start_x, self.start_y, event.x, event.y
             )
+            self.update_live_statistics(self.display_to_image_circle(*self.canvas.coords(self.current_circle)))
+
+    def display_to_image_circle(self, x0, y0, x1, y1):
+        # Calculate circle center and radius in display coordinates
+        cx_display, cy_display = (x0 + x1) / 2, (y0 + y1) / 2
+        # radius_display = ((x1 - x0) ** 2 + (y1 - y0) ** 2) ** 0.5 / 2
+        radius_x_display = (x1 - x0) / 2
+        radius_y_display = (y1 - y0) / 2
+
+        # Map to full-image coordinates
+        cx_full = int(cx_display / self.scale_x)
+        cy_full = int(cy_display / self.scale_y)
+        # radius_full = int(radius_display / self.scale_x)  # Assuming uniform scaling
+        radius_x_full = int(radius_x_display / self.scale_x)
+        radius_y_full = int(radius_y_display / self.scale_y)
+        return cx_full, cy_full, radius_x_full, radius_y_full
 
     def complete_circle(self, event):
         if self.current_circle:
-            # Get display coordinates
-            x0, y0, x1, y1 = self.canvas.coords(self.current_circle)
-
-            # Calculate circle center and radius in display coordinates
-            cx_display, cy_display = (x0 + x1) / 2, (y0 + y1) / 2
-            # radius_display = ((x1 - x0) ** 2 + (y1 - y0) ** 2) ** 0.5 / 2
-            radius_x_display = (x1 - x0) / 2
-            radius_y_display = (y1 - y0) / 2
-
-            # Map to full-image coordinates
-            cx_full = int(cx_display / self.scale_x)
-            cy_full = int(cy_display / self.scale_y)
-            # radius_full = int(radius_display / self.scale_x)  # Assuming uniform scaling
-            radius_x_full = int(radius_x_display / self.scale_x)
-            radius_y_full = int(radius_y_display / self.scale_y)
+            # Get display coordinates, mapped to full-image coordinates
+            cx_full, cy_full, radius_x_full, radius_y_full = self.display_to_image_circle(*self.canvas.coords(self.current_circle))
 
             # Save the circle
             if radius_x_full > 0 and radius_y_full > 0:
@@ -137,19 +186,68 @@ class HepaticRenalRatioAnalyzer():
             # else:
             #     self.hrr_image.kidney_locations.append((cx_full, cy_full, radius_x_full, radius_y_full))
 
+            # The dragged oval is replaced by a tracked item (see redraw_circles)
+            self.canvas.delete(self.current_circle)
             self.current_circle = None
+            self.redraw_circles()
+            self.update_live_statistics()
 
     def remove_circle(self, event):
         if self.circles[self.current_mode]:
-            # Remove last circle from canvas and data
-            last_circle = self.circles[self.current_mode].pop()
-            if self.current_mode == "Liver":
-                self.hrr_image.liver_locations.pop()
-            else:
-                self.hrr_image.kidney_locations.pop()
-            self.canvas.delete("all")
-            self.update_image()
+            # Remove last circle from canvas and data.
+            # self.circles[mode] is the hrr_image location list itself, so a single pop removes it from both
+            self.circles[self.current_mode].pop()
             self.redraw_circles()
+            self.update_live_statistics()
+
+    def update_live_statistics(self, drawing_circle=None):
+        # drawing_circle: the circle being dragged (full-image coordinates), counted in the current mode
+        if not self.circles["Liver"] and not self.circles["Kidney"] and drawing_circle is None:
+            self.live_label.config(text="")
+            self.outliers = {"Liver": [], "Kidney": []}
+            return
+        if self.live_statistics is None:
+            gray = image_cache.get_gray(self.hrr_image.file_name)
+            if gray is None:
+                return
+            self.live_statistics = LiveROIStatistics(gray)
+        circles = {mode: list(locations) for mode, locations in self.circles.items()}
+        if drawing_circle is not None and drawing_circle[2] > 0 and drawing_circle[3] > 0:
+            circles[self.current_mode].append(drawing_circle)
+        self.show_values(*self.live_statistics.hepatic_renal_ratio(circles["Liver"], circles["Kidney"]))
+        # Outliers among the saved circles (the one being dragged is not flagged)
+        if drawing_circle is None:
+            self.outliers = {mode: flag_outliers(self.live_statistics.roi_means(locations, self.hrr_image.roi_overlap))
+                             for mode, locations in self.circles.items()}
+            self.style_circles()
+
+    def show_stored_statistics(self):
+        # Values and outlier flags of the last analysis, so LiveROIStatistics is only built on the first ROI edit.
+        # Flags stored for a different number of ROIs are stale and not shown
+        img = self.hrr_image
+        if not self.circles["Liver"] and not self.circles["Kidney"]:
+            return
+        self.show_values(img.liver_mean, img.kidney_mean, img.hepatic_renal_ratio)
+        for mode, statistics in (("Liver", img.liver_roi_statistics), ("Kidney", img.kidney_roi_statistics)):
+            if statistics is not None and len(statistics) == len(self.circles[mode]):
+                self.outliers[mode] = [bool(row.get("outlier")) for row in statistics]
+        self.style_circles()
+
+    def show_values(self, liver_mean, kidney_mean, ratio):
+        self.live_label.config(text=f"Liver: {self.format_value(liver_mean, 1)}  Kidney: {self.format_value(kidney_mean, 1)}"
+                                    f"  HRR: {self.format_value(ratio, 3)}")
+
+    def style_circles(self):
+        for mode, items in self.circle_items.items():
+            flags = self.outliers.get(mode, [])
+            for index, item in enumerate(items):
+                outlier = index < len(flags) and flags[index]
+                self.canvas.itemconfig(item, outline=OUTLIER_COLOR if outlier else CIRCLE_COLORS[mode],
+                                       dash=OUTLIER_DASH if outlier else "")
+
+    @staticmethod
+    def format_value(value, digits):
+        return "-" if value is None else f"{value:.{digits}f}"
 
     def redraw_circles(self):
         # Get scaling ratios
@@ -159,26 +257,31 @@ class HepaticRenalRatioAnalyzer():
         x_ratio = displayed_width / original_width
         y_ratio = displayed_height / original_height
 
-        for mode, color in [("Liver", "blue"), ("Kidney", "yellow")]:
-            # cs = ast.literal_eval(self.circles[mode]) if type(self.circles[mode]) is str else self.circles[mode]
-            for cx, cy, radius_x, radius_y in self.circles[mode]:
+        for mode, color in CIRCLE_COLORS.items():
+            # Oval items are kept in sync with the circle list: extra items are deleted, missing ones created,
+            # and existing ones are only moved
+            items = self.circle_items[mode]
+            while len(items) > len(self.circles[mode]):
+                self.canvas.delete(items.pop())
+            for index, (cx, cy, radius_x, radius_y) in enumerate(self.circles[mode]):
                 scaled_cx = cx * x_ratio
                 scaled_cy = cy * y_ratio
                 scaled_radius_x = radius_x * x_ratio
                 scaled_radius_y = radius_y * y_ratio
-                self.canvas.create_oval(
-                    scaled_cx - scaled_radius_x, scaled_cy - scaled_radius_y,
-                    scaled_cx + scaled_radius_x, scaled_cy + scaled_radius_y,
-                    outline=color, fill="", width=2
-                )
+                coords = (scaled_cx - scaled_radius_x, scaled_cy - scaled_radius_y,
+                          scaled_cx + scaled_radius_x, scaled_cy + scaled_radius_y)
+                if index < len(items):
+                    self.canvas.coords(items[index], *coords)
+                else:
+                    items.append(self.canvas.create_oval(*coords, outline=color, fill="", width=2))
+        self.style_circles()
 
     def clear_all(self):
-        # Clear all circles and reset data
-        self.circles = {"Liver": [], "Kidney": []}
-        self.hrr_image.liver_locations.clear()
-        self.hrr_image.kidney_locations.clear()
-        self.canvas.delete("all")
-        self.update_image()
+        # Clear all circles and reset data (in place, the lists are shared with hrr_image)
+        self.circles["Liver"].clear()
+        self.circles["Kidney"].clear()
+        self.redraw_circles()
+        self.update_live_statistics()
 
     def analyze(self):
         try:
@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+import numpy as np
+from ROIHistogram import ROIHistogram
+
+# LRR_annotations.json holds the file names and ROIs of a folder (readable, diffable);
+# LRR_annotations.npz holds the per-image statistics and ROI histograms as arrays.
+ANNOTATIONS_FILE = "LRR_annotations.json"
+ARRAYS_FILE = "LRR_annotations.npz"
+SCHEMA_VERSION = 1
+
+STATISTICS_COLUMNS = ["liver_mean", "kidney_mean", "liver_std", "kidney_std",
+                      "hepatic_renal_ratio", "hepatic_renal_ratio_std", "hepatic_renal_ratio_ci_low",
+                      "hepatic_renal_ratio_ci_high"]
+HISTOGRAM_COLUMNS = ["liver_histogram", "kidney_histogram"]
+# Per-ROI statistics are small and kept with the ROIs in the manifest
+ROI_STATISTICS_COLUMNS = ["liver_roi_statistics", "kidney_roi_statistics"]
+
+
+def _atomic_write(path, write):
+    # Write to a temporary file first, so an interrupted save never leaves a truncated file
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as file:
+        write(file)
+    os.replace(temporary_path, path)
+
+
+def save_annotations(folder, records):
+    # records: dictionaries as returned by HepaticRenalRatioImage.get_parameters (or ResultsStore.load_all)
+    from HepaticRenalRatioImage import parse_stored_value
+    images = []
+    statistics = np.full((len(records), len(STATISTICS_COLUMNS)), np.nan)
+    histograms = {column: [] for column in HISTOGRAM_COLUMNS}
+    for index, record in enumerate(records):
+        images.append({
+            "file_name": record["file_name"],
+            "liver_locations": [list(location) for location in parse_stored_value(record.get("liver_locations")) or []],
+            "kidney_locations": [list(location) for location in parse_stored_value(record.get("kidney_locations")) or []],
+        })
+        for column in ROI_STATISTICS_COLUMNS:
+            if record.get(column) is not None:
+                images[-1][column] = parse_stored_value(record[column])
+        for column_index, column in enumerate(STATISTICS_COLUMNS):
+            if record.get(column) is not None:
+                statistics[index, column_index] = record[column]
+        for column in HISTOGRAM_COLUMNS:
+            histogram = record.get(column)
+            if histogram is not None and not isinstance(histogram, ROIHistogram):
+                histogram = ROIHistogram.from_dict(histogram)
+            histograms[column].append(histogram)
+
+    arrays = {"statistics": statistics}
+    for column, column_histograms in histograms.items():
+        # Dense (images x bins) count matrix; rows of images without a histogram are flagged in *_present
+        bins = max((len(h.counts) for h in column_histograms if h is not None), default=0)
+        if bins:
+            matrix = np.zeros((len(records), bins), dtype=np.int64)
+            for index, histogram in enumerate(column_histograms):
+                if histogram is not None:
+                    matrix[index, :len(histogram.counts)] = histogram.counts
+            arrays[column] = matrix
+            arrays[f"{column}_present"] = np.array([h is not None for h in column_histograms], dtype=bool)
+
+    manifest = {"schema_version": SCHEMA_VERSION, "statistics_columns": STATISTICS_COLUMNS, "images": images}
+    _atomic_write(os.path.join(folder, ANNOTATIONS_FILE), lambda file: file.write(json.dumps(manifest).encode()))
+    _atomic_write(os.path.join(folder, ARRAYS_FILE), lambda file: np.savez_compressed(file, **arrays))
+
+
+def load_annotations(folder_or_path):
+    # Records of a folder (or of an LRR_annotations.json path), ready for HepaticRenalRatioImage(params=...).
+    # Statistics and histograms are read as whole arrays from the sidecar, not parsed per row.
+    annotations_path = folder_or_path
+    if os.path.isdir(folder_or_path):
+        annotations_path = os.path.join(folder_or_path, ANNOTATIONS_FILE)
+    with open(annotations_path, "rb") as file:
+        manifest = json.load(file)
+    if manifest.get("schema_version", 0) > SCHEMA_VERSION:
+        raise ValueError(f"'{annotations_path}' was written by a newer version (schema {manifest['schema_version']})")
+
+    records = [{"file_name": image["file_name"],
+                "liver_locations": [tuple(location) for location in image["liver_locations"]],
+                "kidney_locations": [tuple(location) for location in image["kidney_locations"]]}
+               for image in manifest["images"]]
+    for record, image in zip(records, manifest["images"]):
+        for column in ROI_STATISTICS_COLUMNS:
+            if column in image:
+                record[column] = image[column]
+
+    arrays_path = os.path.join(os.path.dirname(annotations_path), ARRAYS_FILE)
+    if not os.path.exists(arrays_path):
+        return records
+    with np.load(arrays_path) as arrays:
+        statistics = arrays["statistics"]
+        for column_index, column in enumerate(manifest["statistics_columns"]):
+            values = statistics[:, column_index]
+            missing = np.isnan(values)
+            for record, value, is_missing in zip(records, values.tolist(), missing.tolist()):
+                record[column] = None if is_missing else value
+        for column in HISTOGRAM_COLUMNS:
+            if column not in arrays:
+                continue
+            for record, counts, present in zip(records, arrays[column], arrays[f"{column}_present"]):
+                record[column] = ROIHistogram(counts) if present else None
+    return records
+
+
+def migrate_excel(folder):
+    # Converts the string columns of an existing LRR_results.xlsx into the annotation files
+    from HepaticRenalRatioResults import read_excel_rows, RESULTS_EXCEL
+    save_annotations(folder, read_excel_rows(os.path.join(folder, RESULTS_EXCEL)))
+
+
+if __name__ == "__main__":
+    # python HepaticRenalRatioAnnotations.py <folder>: migrate the folder's LRR_results.xlsx
+    for folder in sys.argv[1:]:
+        migrate_excel(folder)
+        print(f"Annotations written to: {os.path.join(folder, ANNOTATIONS_FILE)}")
@@ -0,0 +1,96 @@
+import os
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, CancelledError
+from HepaticRenalRatioImage import HepaticRenalRatioImage
+from DecodedImageCache import image_cache
+from StageProfiler import profiler
+
+# Workers decode every image once, so they do not keep a decoded image cache of their own
+WORKER_IMAGE_CACHE_MB = 0
+
+
+def _init_worker(image_cache_mb):
+    image_cache.set_budget(image_cache_mb)
+
+
+def analyze_image_task(params, histogram_path = None, multi_frame = False):
+    # Runs in a worker process: decode the image, compute the ROI statistics and their bootstrap interval,
+    # and optionally save the histogram figure.
+    # Only the file name and ROI locations are needed, results come back in compact (histogram) form.
+    img = HepaticRenalRatioImage(file_name = '', params = params, compact = True, multi_frame = multi_frame)
+    flag = img.read_pixels() # None / False if no locations are chosen for both liver and kidney
+    if flag:
+        # The bootstrap interval is only computed here, never in the interactive analysis
+        with profiler.stage("bootstrap", img.file_name):
+            img.calculate_ratio_interval()
+    if flag and histogram_path is not None:
+        img.create_picture_with_histograms(path = histogram_path)
+    # Stage timings of this image (empty unless profiling is enabled)
+    return flag, img.get_parameters(), profiler.pop_image_rows(img.file_name)
+
+
+class BatchAnalyzer:
+    # Fans analyze_image_task out to a process pool. Completed results are queued and
+    # collected with poll(), so a Tk application can consume them from its main loop.
+    def __init__(self, workers = None, multi_frame = False):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.multi_frame = multi_frame  # Per-frame HRR of cine loops, see HepaticRenalRatioImage.read_frames
+        self.executor = None
+        self.results = queue.Queue()
+        self.total = 0
+        self.completed = 0
+        self.cancelled = False
+        self.stage_rows = []  # StageProfiler rows sent back by the workers
+
+    def start(self, jobs):
+        # jobs: iterable of (key, params, histogram_path)
+        jobs = list(jobs)
+        self.total = len(jobs)
+        self.completed = 0
+        self.cancelled = False
+        # Spawned (not forked) workers, so they do not inherit the Tk interpreter state.
+        # Workers only import what analysis needs; matplotlib is loaded when a histogram figure is requested
+        self.executor = ProcessPoolExecutor(max_workers = self.workers, mp_context = multiprocessing.get_context("spawn"),
+                                            initializer = _init_worker, initargs = (WORKER_IMAGE_CACHE_MB,))
+        for key, params, histogram_path in jobs:
+            future = self.executor.submit(analyze_image_task, params, histogram_path, self.multi_frame)
+            future.add_done_callback(lambda f, key = key: self._on_done(key, f))
+
+    def _on_done(self, key, future):
+        # Called from the executor's thread; only hands the result over to poll()
+        try:
+            flag, params, stage_rows = future.result()
+            self.stage_rows.extend(stage_rows)
+            self.results.put((key, "done" if flag else "skipped", params))
+        except CancelledError:
+            self.results.put((key, "cancelled", None))
+        except Exception as e:
+            self.results.put((key, "error", e))
+
+    def poll(self):
+        # Returns the (key, status, params_or_error) tuples completed since the last call
+        completed = []
+        while True:
+            try:
+                completed.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        self.completed += len(completed)
+        if self.cancelled:
+            # Results arriving after cancellation are discarded, never applied
+            completed = [(key, "cancelled", None) for key, _, _ in completed]
+        if self.done and self.executor is not None:
+            self.executor.shutdown(wait = False)
+            self.executor = None
+        return completed
+
+    def cancel(self):
+        # Pending images are dropped, running ones finish in the background and are ignored
+        self.cancelled = True
+        if self.executor is not None:
+            self.executor.shutdown(wait = False, cancel_futures = True)
+
+    @property
+    def done(self):
+        return self.completed >= self.total
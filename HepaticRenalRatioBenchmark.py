@@ -0,0 +1,307 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import contextlib
+import tempfile
+import platform
+import subprocess
+import multiprocessing
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import cv2
+from HepaticRenalRatioImage import HepaticRenalRatioImage
+from HepaticRenalRatioResults import ResultsStore
+from HepaticRenalRatioBatch import BatchAnalyzer
+from DecodedImageCache import image_cache
+from ROIHistogram import ROIHistogram
+from BootstrapCI import image_rng, ratio_interval
+
+RESOLUTIONS = [(480, 640), (1080, 1440), (2160, 2880)]
+BIT_DEPTHS = [8, 16]
+ROI_COUNTS = [1, 4, 8]
+ROI_RADII = [20, 80]
+BOOTSTRAP_ROI_SHAPES = [(40, 40), (200, 200)]  # Pixels resampled per organ
+FOLDER_SIZES = [10, 100, 1000, 5000]
+QUICK_FOLDER_SIZES = [10, 100]
+REGRESSION_THRESHOLD = 1.2  # Slower than the baseline by more than this factor is reported as a regression
+# Modules timed by --startup: the GUI, the CLI, and what every Analyze All worker imports
+STARTUP_MODULES = ["LRRatioAnalyzer_GUI", "HepaticRenalRatioCLI", "HepaticRenalRatioBatch"]
+STARTUP_TARGET_S = 0.5  # Import time above this is reported as a failure
+# Dependencies that must not be imported at startup, only on the code paths that need them
+LAZY_MODULES = ["pandas", "matplotlib", "cv2", "tifffile"]
+STARTUP_SCRIPT = (
+    "import sys, time, json; start = time.perf_counter(); import {module}; elapsed = time.perf_counter() - start; "
+    "print(json.dumps([elapsed, [name for name in {lazy!r} if name in sys.modules]]))"
+)
+
+
+def synthetic_ultrasound(shape, bit_depth, rng):
+    # Rayleigh speckle over a depth-attenuated background, with a brighter elliptical "kidney" region
+    height, width = shape
+    y_grid, x_grid = np.ogrid[:height, :width]
+    attenuation = np.exp(-1.5 * y_grid / height)
+    kidney = (((x_grid - 0.65 * width) / (0.15 * width)) ** 2 + ((y_grid - 0.6 * height) / (0.1 * height)) ** 2) <= 1
+    intensity = rng.rayleigh(0.2, size=shape) * attenuation * np.where(kidney, 1.4, 1.0)
+    maximum = 255 if bit_depth == 8 else 65535
+    return np.clip(intensity * maximum, 0, maximum).astype(np.uint8 if bit_depth == 8 else np.uint16)
+
+
+def synthetic_rois(shape, count, radius, rng):
+    # Liver ROIs on the left half, kidney ROIs on the right half
+    height, width = shape
+    radius = min(radius, height // 4, width // 8)
+    def rois(x_low, x_high):
+        return [(int(rng.integers(x_low, x_high)), int(rng.integers(radius, height - radius)), radius, radius)
+                for _ in range(count)]
+    return rois(radius, width // 2 - radius), rois(width // 2 + radius, width - radius)
+
+
+def write_image(folder, name, shape, bit_depth, rng):
+    path = os.path.join(folder, name)
+    cv2.imwrite(path, synthetic_ultrasound(shape, bit_depth, rng))
+    return path
+
+
+def measure(function, repeat):
+    # Latencies of repeated calls, then one more call under tracemalloc for the peak allocation
+    latencies = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start_time)
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies = np.array(latencies)
+    return {"median_s": float(np.median(latencies)), "p95_s": float(np.percentile(latencies, 95)),
+            "throughput_per_s": float(1 / np.median(latencies)), "peak_bytes": int(peak)}
+
+
+def bench_images(folder, repeat, rng, quick):
+    results = {}
+    resolutions = RESOLUTIONS[:2] if quick else RESOLUTIONS
+    for shape in resolutions:
+        for bit_depth in BIT_DEPTHS:
+            path = write_image(folder, f"image_{shape[0]}x{shape[1]}_{bit_depth}bit.tif", shape, bit_depth, rng)
+            for count in ROI_COUNTS:
+                for radius in ROI_RADII:
+                    liver, kidney = synthetic_rois(shape, count, radius, rng)
+                    case = f"{shape[0]}x{shape[1]}/{bit_depth}bit/{count}roi/r{radius}"
+                    img = HepaticRenalRatioImage(path, liver, kidney, compact=True)
+
+                    def read_cold():
+                        image_cache.clear()
+                        img.read_pixels()
+                    results[f"read_pixels_cold/{case}"] = measure(read_cold, repeat)
+                    results[f"read_pixels_warm/{case}"] = measure(img.read_pixels, repeat)
+
+            # Persistence and rendering depend on the ROI data, not on the ROI layout
+            full = HepaticRenalRatioImage(path, liver, kidney)
+            full.read_pixels()
+            for mode, source in (("compact", img), ("pixels", full)):
+                params = source.get_parameters()
+                stored = {key: json.dumps(value) if isinstance(value, (list, dict)) else value for key, value in params.items()}
+                results[f"get_parameters/{mode}/{shape[0]}x{shape[1]}/{bit_depth}bit"] = measure(source.get_parameters, repeat)
+                results[f"load_from_dictionary/{mode}/{shape[0]}x{shape[1]}/{bit_depth}bit"] = measure(
+                    lambda: HepaticRenalRatioImage('', params=stored, compact=mode == "compact"), repeat)
+            histogram_path = os.path.join(folder, "histogram.png")
+            with contextlib.redirect_stdout(None):  # "Histogram figure saved to" per call
+                results[f"create_picture_with_histograms/{shape[0]}x{shape[1]}/{bit_depth}bit"] = measure(
+                    lambda: img.create_picture_with_histograms(path=histogram_path), repeat)
+    return results
+
+
+def bench_bootstrap(repeat, rng):
+    # Bootstrap interval of one image, from ROI histograms of speckle-like intensities
+    results = {}
+    for shape in BOOTSTRAP_ROI_SHAPES:
+        liver = ROIHistogram.from_pixels(synthetic_ultrasound(shape, 8, rng))
+        kidney = ROIHistogram.from_pixels(synthetic_ultrasound(shape, 8, rng))
+        results[f"bootstrap_ci/{shape[0]}x{shape[1]}"] = measure(
+            lambda: ratio_interval(liver, kidney, rng=image_rng("image.tif")), repeat)
+    return results
+
+
+def bench_folder(folder, size, workers, rng):
+    # Analyze All over a folder of small images: results store upserts, batch analysis and the workbook export.
+    # Run through run_isolated, so peak_child_rss_bytes is that of this folder's workers only
+    shape = (480, 640)
+    template = synthetic_ultrasound(shape, 8, rng)
+    images = []
+    for index in range(size):
+        path = os.path.join(folder, f"frame_{index:05d}.tif")
+        cv2.imwrite(path, np.roll(template, index, axis=1))
+        liver, kidney = synthetic_rois(shape, 4, 30, rng)
+        images.append(HepaticRenalRatioImage(path, liver, kidney, compact=True))
+
+    results = {}
+    store = ResultsStore(os.path.join(folder, "LRR_results.sqlite"))
+    start_time = time.perf_counter()
+    for img in images:
+        store.upsert(img.get_parameters())
+    elapsed = time.perf_counter() - start_time
+    results[f"store_upsert/{size}"] = {"median_s": elapsed / size, "throughput_per_s": size / elapsed}
+
+    jobs = [(index, {"file_name": img.file_name, "liver_locations": img.liver_locations,
+                     "kidney_locations": img.kidney_locations}, None) for index, img in enumerate(images)]
+    batch = BatchAnalyzer(workers=workers)
+    start_time = time.perf_counter()
+    batch.start(jobs)
+    latencies = []
+    while not batch.done:
+        for index, status, params in batch.poll():
+            if status == "done":
+                store.upsert(params, commit=False)
+            latencies.append(time.perf_counter() - start_time)
+        store.commit()
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start_time
+    while multiprocessing.active_children():  # Workers only count towards RUSAGE_CHILDREN once they are reaped
+        time.sleep(0.01)
+    results[f"analyze_all/{size}/{batch.workers}workers"] = {
+        "total_s": elapsed, "throughput_per_s": size / elapsed,
+        "first_result_s": min(latencies) if latencies else None, "peak_child_rss_bytes": _child_peak_rss()}
+
+    start_time = time.perf_counter()
+    store.export_excel(os.path.join(folder, "LRR_results.xlsx"))
+    results[f"export_excel/{size}"] = {"total_s": time.perf_counter() - start_time}
+    store.close()
+    return results
+
+
+def bench_startup(repeat, modules = STARTUP_MODULES):
+    # Import time of each module in a fresh interpreter (as a cold start of the application or a worker),
+    # and the heavy dependencies it pulled in
+    results = {}
+    for module in modules:
+        latencies = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT.format(module=module, lazy=LAZY_MODULES)],
+                                    cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+                                    check=True).stdout
+            process_time = time.perf_counter() - start_time
+            elapsed, loaded = json.loads(output.splitlines()[-1])
+            latencies.append((elapsed, process_time))
+        results[f"startup/{module}"] = {"median_s": float(np.median([l[0] for l in latencies])),
+                                        "process_s": float(np.median([l[1] for l in latencies])),
+                                        "eager_modules": loaded}
+    return results
+
+
+def check_startup(results, target):
+    # Names of the modules over the target import time or importing a lazy dependency eagerly
+    failures = []
+    for name, result in results.items():
+        if not name.startswith("startup/"):
+            continue
+        problems = []
+        if result["median_s"] > target:
+            problems.append(f"{result['median_s']:.2f}s > {target:.2f}s")
+        if result["eager_modules"]:
+            problems.append(f"imports {', '.join(result['eager_modules'])}")
+        print(f"{name:70s} {'; '.join(problems) or 'OK'}")
+        if problems:
+            failures.append(name)
+    return failures
+
+
+def run_isolated(function, *args):
+    # Runs function(*args) in a fresh (spawned) process, so the peak RSS of its children only covers
+    # its own worker processes, not those of earlier benchmarks
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(function, *args).result()
+
+
+def _child_peak_rss():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macOS, kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+
+
+def compare(results, baseline):
+    # Ratio of the current to the baseline timing per benchmark; returns the regressed benchmarks
+    regressions = []
+    for name, current in sorted(results.items()):
+        reference = baseline.get("results", {}).get(name)
+        if reference is None:
+            continue
+        for metric in ("median_s", "total_s"):
+            if current.get(metric) and reference.get(metric):
+                ratio = current[metric] / reference[metric]
+                flag = "REGRESSION" if ratio > REGRESSION_THRESHOLD else ""
+                print(f"{name:70s} {metric:9s} {ratio:6.2f}x {flag}")
+                if flag:
+                    regressions.append(name)
+    return regressions
+
+
+def print_report(results):
+    print(f"{'benchmark':70s} {'latency':>10s} {'per second':>11s} {'peak MB':>8s}")
+    for name, result in results.items():
+        latency = result.get("median_s", result.get("total_s"))
+        peak = result.get("peak_bytes", result.get("peak_child_rss_bytes"))
+        print(f"{name:70s} {latency * 1000:8.2f}ms {result.get('throughput_per_s', 0):11.1f} "
+              f"{'' if peak is None else f'{peak / 2 ** 20:8.1f}'}")
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the analysis, persistence and rendering hot paths.")
+    parser.add_argument("--quick", action="store_true", help="Smaller resolutions and folders (10 and 100 images)")
+    parser.add_argument("--folder-sizes", type=int, nargs="*", help=f"Folder sizes for Analyze All (default: {FOLDER_SIZES})")
+    parser.add_argument("--repeat", type=int, default=5, help="Repetitions per single-image benchmark")
+    parser.add_argument("--workers", type=int, default=None, help="Analyze All worker processes (default: CPU count)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="Write the results as JSON (usable as a baseline)")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated images")
+    parser.add_argument("--startup", action="store_true", help="Only measure the import (cold start) time")
+    parser.add_argument("--startup-target", type=float, default=STARTUP_TARGET_S,
+                        help=f"Maximum import time in seconds (default: {STARTUP_TARGET_S})")
+    args = parser.parse_args(argv)
+
+    results = bench_startup(args.repeat)
+    if not args.startup:
+        rng = np.random.default_rng(args.seed)
+        folder = tempfile.mkdtemp(prefix="hrr_benchmark_")
+        folder_sizes = args.folder_sizes if args.folder_sizes is not None else (QUICK_FOLDER_SIZES if args.quick else FOLDER_SIZES)
+        try:
+            results.update(bench_images(folder, args.repeat, rng, args.quick))
+            results.update(bench_bootstrap(args.repeat, rng))
+            for size in folder_sizes:
+                size_folder = os.path.join(folder, f"folder_{size}")
+                os.makedirs(size_folder)
+                results.update(run_isolated(bench_folder, size_folder, size, args.workers, rng))
+        finally:
+            if args.keep:
+                print(f"Generated images kept in: {folder}")
+            else:
+                shutil.rmtree(folder, ignore_errors=True)
+
+    print_report(results)
+    startup_failures = check_startup(results, args.startup_target)
+    report = {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+              "seed": args.seed, "results": results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file))
+        if regressions:
+            print(f"{len(regressions)} regression(s) against {args.baseline}")
+            return 1
+    return 1 if startup_failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
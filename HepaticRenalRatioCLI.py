@@ -0,0 +1,135 @@
+import os
+import csv
+import time
+import argparse
+
+# Headless: histograms are rendered on an Agg canvas (see HistogramRenderer), tkinter is never imported
+from HepaticRenalRatioBatch import BatchAnalyzer
+from HepaticRenalRatioResults import ResultsStore, load_records, to_stored_value, EXCLUDED_COLUMNS, EXCEL_EXCLUDED_COLUMNS
+from StageProfiler import profiler
+
+# Columns written to CSV, same order as HepaticRenalRatioImage.get_parameters
+CSV_COLUMNS = ["file_name", "liver_locations", "kidney_locations", "liver_mean", "kidney_mean", "liver_std",
+               "kidney_std", "hepatic_renal_ratio", "hepatic_renal_ratio_std", "hepatic_renal_ratio_ci_low",
+               "hepatic_renal_ratio_ci_high"]
+# Added with --multi-frame
+FRAME_COLUMNS = ["frame_count", "frame_hepatic_renal_ratios", "hepatic_renal_ratio_frames_mean",
+                 "hepatic_renal_ratio_frames_median", "hepatic_renal_ratio_frames_std"]
+
+
+class CsvResultWriter:
+    # Appends one row per analyzed image and flushes it, so partial runs keep their results.
+    # Lists are written as JSON, as in the results store
+    def __init__(self, path, columns = CSV_COLUMNS):
+        self.file = open(path, "w", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=columns, extrasaction="ignore")
+        self.writer.writeheader()
+
+    def write(self, params):
+        self.writer.writerow({key: to_stored_value(value) for key, value in params.items()})
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class SqliteResultWriter:
+    def __init__(self, path):
+        self.store = ResultsStore(path)
+
+    def write(self, params):
+        self.store.upsert(params)
+
+    def close(self):
+        self.store.close()
+
+
+def resolve_file_name(file_name, folder):
+    # Results created on another machine keep absolute paths; fall back to the file next to the results
+    if not os.path.exists(file_name) and folder is not None:
+        local_name = os.path.join(folder, os.path.basename(file_name))
+        if os.path.exists(local_name):
+            return local_name
+    return file_name
+
+
+def run(source, output, workers = None, histograms = False, progress = True, multi_frame = False):
+    folder = source if os.path.isdir(source) else os.path.dirname(os.path.abspath(source))
+    records = load_records(source)
+    results_path = os.path.join(folder, "results")
+    if histograms:
+        os.makedirs(results_path, exist_ok=True)
+
+    jobs = []
+    for index, record in enumerate(records):
+        params = {"file_name": resolve_file_name(record["file_name"], folder),
+                  "liver_locations": record.get("liver_locations") or [],
+                  "kidney_locations": record.get("kidney_locations") or []}
+        histogram_path = None
+        if histograms:
+            histogram_path = os.path.join(results_path, f"{os.path.basename(params['file_name'])}_histogram.png")
+        jobs.append((index, params, histogram_path))
+
+    if output.endswith((".sqlite", ".db")):
+        writer = SqliteResultWriter(output)
+    else:
+        writer = CsvResultWriter(output, CSV_COLUMNS + FRAME_COLUMNS if multi_frame else CSV_COLUMNS)
+    counts = {"done": 0, "skipped": 0, "error": 0, "cancelled": 0}
+    batch = BatchAnalyzer(workers = workers, multi_frame = multi_frame)
+    start_time = time.perf_counter()
+    reported = None
+    try:
+        batch.start(jobs)
+        while not batch.done:
+            for index, status, result in batch.poll():
+                counts[status] += 1
+                if status == "done":
+                    with profiler.stage("store", result["file_name"]):
+                        writer.write({k: v for k, v in result.items() if k not in EXCLUDED_COLUMNS + EXCEL_EXCLUDED_COLUMNS})
+                elif status == "error":
+                    print(f"Failed to analyze {jobs[index][1]['file_name']}: {result}")
+            if progress and batch.completed != reported:
+                reported = batch.completed
+                print(f"\r{batch.completed}/{batch.total} images", end="", flush=True)
+            time.sleep(0.05)
+    except KeyboardInterrupt:
+        batch.cancel()
+        print("\nCancelled")
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - start_time
+    print(f"\nAnalyzed {counts['done']} images ({counts['skipped']} without ROIs, {counts['error']} failed) "
+          f"in {elapsed:.1f}s, results written to {output}")
+    if profiler.enabled:
+        profiler.add_rows(batch.stage_rows)
+        timings_path = f"{os.path.splitext(output)[0]}_timings.csv"
+        profiler.write_log(timings_path)
+        print(profiler.summary())
+        print(f"Stage timings written to {timings_path}")
+    return counts
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Headless hepatic-renal ratio analysis of annotated images.")
+    parser.add_argument("source", help="Folder of .tif images, or an LRR_results.sqlite / LRR_annotations.json / LRR_results.xlsx file with ROIs")
+    parser.add_argument("-o", "--output", help="Output .csv or .sqlite file (default: LRR_results.csv next to the source)")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Number of worker processes (default: CPU count)")
+    parser.add_argument("--histograms", action="store_true", help="Save histogram figures to the results folder")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Do not print progress")
+    parser.add_argument("--multi-frame", action="store_true", help="Also report the HRR of every frame of multi-frame TIFFs")
+    parser.add_argument("--profile", action="store_true", help="Record per-stage timings (same as HRR_PROFILE=1)")
+    args = parser.parse_args(argv)
+    if args.profile:
+        profiler.enable()
+
+    output = args.output
+    if output is None:
+        folder = args.source if os.path.isdir(args.source) else os.path.dirname(os.path.abspath(args.source))
+        output = os.path.join(folder, "LRR_results.csv")
+    run(args.source, output, workers = args.workers, histograms = args.histograms, progress = not args.quiet,
+        multi_frame = args.multi_frame)
+
+
+if __name__ == "__main__":
+    main()
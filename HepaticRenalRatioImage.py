@@ -1,65 +1,190 @@
 import numpy as np
 import ast
 import os
-import cv2
-from collections import defaultdict
-import matplotlib.pyplot as plt
-from pandas.core.computation.ops import isnumeric
+import json
+import numbers
+from ROIMaskEngine import default_mask_engine
+from ROIHistogram import ROIHistogram
+from DecodedImageCache import image_cache
+from StageProfiler import profiler
+from CineLoop import DEFAULT_MAX_FRAMES_IN_MEMORY, iter_frame_chunks, frame_means
+from BootstrapCI import DEFAULT_RESAMPLES, image_rng, ratio_interval
+from ROIStatistics import roi_statistics
+
+# Stored with the results fingerprints; bump it when the analysis changes so old results are recomputed
+ANALYSIS_VERSION = 3
+
+
+def _none_if_missing(value):
+    # Spreadsheets return NaN for empty cells
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def parse_stored_value(value):
+    # Stored lists are JSON; results written by older versions hold Python reprs (with tuples)
+    if type(value) is not str:
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return ast.literal_eval(value)
 
 
 class HepaticRenalRatioImage:
-    def __init__(self, file_name, liver_locations = [], kidney_locations = [], params = None):
-        if params is not None:
-            self.load_from_dictionary(params)
-        else:
-            self.file_name = file_name
-            self.liver_locations = liver_locations  # Array of (x, y, x-radius,y-radius)
-            self.kidney_locations = kidney_locations  # Array of (x, y, x-radius,y-radius)
+    def __init__(self, file_name, liver_locations = None, kidney_locations = None, params = None, compact = False,
+                 multi_frame = False, roi_overlap = "first"):
+        # In compact mode, ROI pixels are kept as ROIHistogram objects instead of Python lists
+        self.compact = compact
+        # In multi-frame mode, read_pixels also computes the HRR of every frame of a cine loop (see read_frames)
+        self.multi_frame = multi_frame
+        # Which ellipse owns pixels where ROIs of an organ overlap (see ROIMaskEngine.build_label_map)
+        self.roi_overlap = roi_overlap
         self.liver_pixels = None
         self.kidney_pixels = None
+        self.liver_histogram = None
+        self.kidney_histogram = None
         self.liver_mean = None
         self.kidney_mean = None
         self.liver_std = None
         self.kidney_std = None
         self.hepatic_renal_ratio = None
         self.hepatic_renal_ratio_std = None
+        self.hepatic_renal_ratio_ci_low = None
+        self.hepatic_renal_ratio_ci_high = None
+        self.liver_roi_statistics = None  # One dictionary per ROI, see ROIStatistics.roi_statistics
+        self.kidney_roi_statistics = None
+        self.frame_count = None
+        self.frame_hepatic_renal_ratios = None
+        self.hepatic_renal_ratio_frames_mean = None
+        self.hepatic_renal_ratio_frames_median = None
+        self.hepatic_renal_ratio_frames_std = None
+        if params is not None:
+            self.load_from_dictionary(params)
+        else:
+            self.file_name = file_name
+            self.liver_locations = liver_locations if liver_locations is not None else []  # Array of (x, y, x-radius,y-radius)
+            self.kidney_locations = kidney_locations if kidney_locations is not None else []  # Array of (x, y, x-radius,y-radius)
 
     def read_pixels(self):
-        # Read the image
-        image = cv2.imread(self.file_name, cv2.IMREAD_GRAYSCALE)
+        # Read the image (decoded once per process, see DecodedImageCache)
+        with profiler.stage("decode", self.file_name):
+            image = image_cache.get_gray(self.file_name)
         if image is None:
             raise FileNotFoundError(f"Image file '{self.file_name}' not found.")
         if len(self.kidney_locations) == 0 or len(self.liver_locations) ==0:
             return None
-        # Function to get unique pixel values inside circles
-        def get_circle_pixels(locations):
-            mask = np.zeros_like(image, dtype=bool)
-            for x, y, x_radius, y_radius in locations:
-                y_grid, x_grid = np.ogrid[:image.shape[0], :image.shape[1]]
-                circle_mask = (((x_grid - x) / x_radius) ** 2 + ((y_grid - y) / y_radius) ** 2) <= 1
-                mask |= circle_mask
-            return image[mask].flatten().tolist()
-
-        # Get unique pixel values for liver and kidney locations
-        self.liver_pixels = get_circle_pixels(self.liver_locations)
-        self.kidney_pixels = get_circle_pixels(self.kidney_locations)
+        # One label per ellipse over the bounding box of the organ's ellipses (each rasterized only within
+        # its own bounding box, using cached stencils), overlapping pixels belong to a single ellipse
+        with profiler.stage("mask", self.file_name):
+            liver_rows, liver_columns, liver_labels = default_mask_engine.build_label_map(
+                image.shape, self.liver_locations, self.roi_overlap)
+            kidney_rows, kidney_columns, kidney_labels = default_mask_engine.build_label_map(
+                image.shape, self.kidney_locations, self.roi_overlap)
+            liver_region = image[liver_rows, liver_columns]
+            kidney_region = image[kidney_rows, kidney_columns]
+
+        # Per-ROI histograms in one pass; the organ histogram is their sum
+        with profiler.stage("statistics", self.file_name):
+            bins = ROIHistogram.bins_for(image)
+            liver_rois = ROIHistogram.from_labels(liver_region, liver_labels, len(self.liver_locations), bins)
+            kidney_rois = ROIHistogram.from_labels(kidney_region, kidney_labels, len(self.kidney_locations), bins)
+            self.liver_roi_statistics = roi_statistics(liver_rois)
+            self.kidney_roi_statistics = roi_statistics(kidney_rois)
+            # Pixel lists (in image scan order) are only kept outside compact mode
+            liver_pixels = None if self.compact else liver_region[liver_labels > 0]
+            kidney_pixels = None if self.compact else kidney_region[kidney_labels > 0]
+            self.calculate_statistics(liver_pixels, kidney_pixels, bins,
+                                      ROIHistogram.pooled(liver_rois), ROIHistogram.pooled(kidney_rois))
+
+        if self.multi_frame:
+            self.read_frames()
+
+        return True # That is, success
+
+    def read_frames(self, max_frames_in_memory = DEFAULT_MAX_FRAMES_IN_MEMORY):
+        # Per-frame HRR of a multi-frame TIFF (cine loop). The ROI masks are built once and applied to
+        # a chunk of frames at a time, so at most max_frames_in_memory frames are held in memory.
+        # The single-frame statistics (liver_mean, hepatic_renal_ratio, ...) remain those of the first frame.
+        if len(self.kidney_locations) == 0 or len(self.liver_locations) == 0:
+            return None
+        liver_indices = kidney_indices = None
+        ratios = []
+        with profiler.stage("frames", self.file_name):
+            for _, chunk in iter_frame_chunks(self.file_name, max_frames_in_memory):
+                if liver_indices is None:
+                    liver_indices = np.flatnonzero(default_mask_engine.build_mask(chunk.shape[1:], self.liver_locations))
+                    kidney_indices = np.flatnonzero(default_mask_engine.build_mask(chunk.shape[1:], self.kidney_locations))
+                liver_means = frame_means(chunk, liver_indices)
+                kidney_means = frame_means(chunk, kidney_indices)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    ratios.append(np.where(kidney_means > 0, liver_means / kidney_means, np.nan))
+
+        ratios = np.concatenate(ratios)
+        valid = ratios[~np.isnan(ratios)]
+        self.frame_count = len(ratios)
+        self.frame_hepatic_renal_ratios = [None if np.isnan(ratio) else ratio for ratio in ratios.tolist()]
+        self.hepatic_renal_ratio_frames_mean = float(valid.mean()) if len(valid) else None
+        self.hepatic_renal_ratio_frames_median = float(np.median(valid)) if len(valid) else None
+        self.hepatic_renal_ratio_frames_std = float(valid.std()) if len(valid) else None
+        return True
+
+    def calculate_statistics(self, liver_pixels, kidney_pixels, bins = 256, liver_histogram = None, kidney_histogram = None):
+        # In compact mode, histograms already counted by the caller are used instead of the pixel arrays
+        if self.compact:
+            self.liver_histogram = liver_histogram if liver_histogram is not None else ROIHistogram.from_pixels(liver_pixels, bins=bins)
+            self.kidney_histogram = kidney_histogram if kidney_histogram is not None else ROIHistogram.from_pixels(kidney_pixels, bins=bins)
+            self.liver_pixels = None
+            self.kidney_pixels = None
+        else:
+            self.liver_histogram = None
+            self.kidney_histogram = None
+            self.liver_pixels = liver_pixels.tolist()
+            self.kidney_pixels = kidney_pixels.tolist()
 
         # Calculate statistics
-        if len(self.liver_pixels) > 0:
-            self.liver_mean = np.mean(self.liver_pixels)
-            self.liver_std = np.std(self.liver_pixels)
-        if len(self.kidney_pixels) > 0:
-            self.kidney_mean = np.mean(self.kidney_pixels)
-            self.kidney_std = np.std(self.kidney_pixels)
+        if len(self.liver_histogram if self.compact else self.liver_pixels) > 0:
+            self.liver_mean = self.liver_histogram.mean() if self.compact else np.mean(self.liver_pixels)
+            self.liver_std = self.liver_histogram.std() if self.compact else np.std(self.liver_pixels)
+        if len(self.kidney_histogram if self.compact else self.kidney_pixels) > 0:
+            self.kidney_mean = self.kidney_histogram.mean() if self.compact else np.mean(self.kidney_pixels)
+            self.kidney_std = self.kidney_histogram.std() if self.compact else np.std(self.kidney_pixels)
 
         # Calculate hepatic-renal ratio and standard deviation
-        if self.kidney_mean is not None and isnumeric(self.kidney_mean) and self.kidney_mean > 0:
+        if self.kidney_mean is not None and isinstance(self.kidney_mean, numbers.Real) and self.kidney_mean > 0:
             self.hepatic_renal_ratio = self.liver_mean / self.kidney_mean
             self.hepatic_renal_ratio_std = np.sqrt(
                 (self.liver_std / self.liver_mean)**2 + (self.kidney_std / self.kidney_mean)**2
             ) * self.hepatic_renal_ratio
+        # The bootstrap interval is only computed on request (see calculate_ratio_interval), so it is cleared here
+        self.hepatic_renal_ratio_ci_low = None
+        self.hepatic_renal_ratio_ci_high = None
+
+    def calculate_ratio_interval(self, resamples = DEFAULT_RESAMPLES):
+        # 95% percentile bootstrap interval of the HRR, resampled from the ROI histograms (no Gaussian assumption).
+        # Seeded from the file name, so the interval of an image is the same whichever way it is analyzed.
+        self.hepatic_renal_ratio_ci_low, self.hepatic_renal_ratio_ci_high = ratio_interval(
+            self.get_histogram("liver"), self.get_histogram("kidney"), resamples, rng = image_rng(self.file_name))
+
+    def get_histogram(self, organ):
+        # ROIHistogram of "liver" or "kidney", built from the pixel list if not in compact mode
+        histogram = getattr(self, f"{organ}_histogram")
+        if histogram is None and getattr(self, f"{organ}_pixels") is not None:
+            histogram = ROIHistogram.from_pixels(getattr(self, f"{organ}_pixels"))
+        return histogram
+
+    def get_pixels(self, organ):
+        # Raw pixel values of "liver" or "kidney". In compact mode these are generated from the histogram
+        pixels = getattr(self, f"{organ}_pixels")
+        if pixels is None and getattr(self, f"{organ}_histogram") is not None:
+            pixels = getattr(self, f"{organ}_histogram").to_pixels().tolist()
+        return pixels
+
+    def get_percentile(self, organ, q):
+        histogram = self.get_histogram(organ)
+        return None if histogram is None else histogram.percentile(q)
 
-        return True # That is, success
     def get_parameters(self):
         return {
             "file_name": self.file_name,
@@ -67,69 +192,88 @@ class HepaticRenalRatioImage:
             "kidney_locations": self.kidney_locations,
             "liver_pixels": self.liver_pixels,
             "kidney_pixels": self.kidney_pixels,
+            "liver_histogram": self.liver_histogram.to_dict() if self.liver_histogram is not None else None,
+            "kidney_histogram": self.kidney_histogram.to_dict() if self.kidney_histogram is not None else None,
             "liver_mean": self.liver_mean,
             "kidney_mean": self.kidney_mean,
             "liver_std": self.liver_std,
             "kidney_std": self.kidney_std,
             "hepatic_renal_ratio": self.hepatic_renal_ratio,
-            "hepatic_renal_ratio_std": self.hepatic_renal_ratio_std
+            "hepatic_renal_ratio_std": self.hepatic_renal_ratio_std,
+            "hepatic_renal_ratio_ci_low": self.hepatic_renal_ratio_ci_low,
+            "hepatic_renal_ratio_ci_high": self.hepatic_renal_ratio_ci_high,
+            "liver_roi_statistics": self.liver_roi_statistics,
+            "kidney_roi_statistics": self.kidney_roi_statistics,
+            "frame_count": self.frame_count,
+            "frame_hepatic_renal_ratios": self.frame_hepatic_renal_ratios,
+            "hepatic_renal_ratio_frames_mean": self.hepatic_renal_ratio_frames_mean,
+            "hepatic_renal_ratio_frames_median": self.hepatic_renal_ratio_frames_median,
+            "hepatic_renal_ratio_frames_std": self.hepatic_renal_ratio_frames_std
         }
     def load_from_dictionary(self, params):
         self.file_name = params.get("file_name", None)
-        self.liver_locations = params.get("liver_locations", [])
-        self.kidney_locations = params.get("kidney_locations", [])
-        self.liver_pixels = params.get("liver_pixels", [])
-        self.kidney_pixels = params.get("kidney_pixels", [])
-        self.liver_mean = params.get("liver_mean", None)
-        self.kidney_mean = params.get("kidney_mean", None)
-        self.liver_std = params.get("liver_std", None)
-        self.kidney_std = params.get("kidney_std", None)
-        self.hepatic_renal_ratio = params.get("hepatic_renal_ratio", None)
-        self.hepatic_renal_ratio_std = params.get("hepatic_renal_ratio_std", None)
-
-        # Convert everything to python lists.
-        # This is bad coding, but works
-        # Probably better to use some sort of json.loads
-        self.liver_locations = ast.literal_eval(self.liver_locations) if type(self.liver_locations) is str else self.liver_locations
-        self.kidney_locations = ast.literal_eval(self.kidney_locations) if type(self.kidney_locations) is str else self.kidney_locations
-        self.liver_pixels = ast.literal_eval(self.liver_pixels) if type(self.liver_pixels) is str else self.liver_pixels
-        self.kidney_pixels = ast.literal_eval(self.kidney_pixels) if type(self.kidney_pixels) is str else self.kidney_pixels
+        liver_locations = _none_if_missing(params.get("liver_locations", [])) or []
+        kidney_locations = _none_if_missing(params.get("kidney_locations", [])) or []
+        self.liver_pixels = _none_if_missing(params.get("liver_pixels", None))
+        self.kidney_pixels = _none_if_missing(params.get("kidney_pixels", None))
+        self.liver_histogram = _none_if_missing(params.get("liver_histogram", None))
+        self.kidney_histogram = _none_if_missing(params.get("kidney_histogram", None))
+        self.liver_mean = _none_if_missing(params.get("liver_mean", None))
+        self.kidney_mean = _none_if_missing(params.get("kidney_mean", None))
+        self.liver_std = _none_if_missing(params.get("liver_std", None))
+        self.kidney_std = _none_if_missing(params.get("kidney_std", None))
+        self.hepatic_renal_ratio = _none_if_missing(params.get("hepatic_renal_ratio", None))
+        self.hepatic_renal_ratio_std = _none_if_missing(params.get("hepatic_renal_ratio_std", None))
+        self.hepatic_renal_ratio_ci_low = _none_if_missing(params.get("hepatic_renal_ratio_ci_low", None))
+        self.hepatic_renal_ratio_ci_high = _none_if_missing(params.get("hepatic_renal_ratio_ci_high", None))
+        self.liver_roi_statistics = parse_stored_value(_none_if_missing(params.get("liver_roi_statistics", None)))
+        self.kidney_roi_statistics = parse_stored_value(_none_if_missing(params.get("kidney_roi_statistics", None)))
+        self.frame_count = _none_if_missing(params.get("frame_count", None))
+        self.frame_hepatic_renal_ratios = parse_stored_value(_none_if_missing(params.get("frame_hepatic_renal_ratios", None)))
+        self.hepatic_renal_ratio_frames_mean = _none_if_missing(params.get("hepatic_renal_ratio_frames_mean", None))
+        self.hepatic_renal_ratio_frames_median = _none_if_missing(params.get("hepatic_renal_ratio_frames_median", None))
+        self.hepatic_renal_ratio_frames_std = _none_if_missing(params.get("hepatic_renal_ratio_frames_std", None))
+
+        # Convert everything to python lists, locations as lists of (x, y, x-radius, y-radius) tuples
+        self._set_locations("liver_locations", [tuple(location) for location in parse_stored_value(liver_locations)])
+        self._set_locations("kidney_locations", [tuple(location) for location in parse_stored_value(kidney_locations)])
+        self.liver_pixels = parse_stored_value(self.liver_pixels)
+        self.kidney_pixels = parse_stored_value(self.kidney_pixels)
+        self.liver_histogram = ROIHistogram.from_dict(self.liver_histogram) if self.liver_histogram is not None and not isinstance(self.liver_histogram, ROIHistogram) else self.liver_histogram
+        self.kidney_histogram = ROIHistogram.from_dict(self.kidney_histogram) if self.kidney_histogram is not None and not isinstance(self.kidney_histogram, ROIHistogram) else self.kidney_histogram
+        # Pixel lists are only kept outside compact mode
+        if self.compact:
+            self.liver_histogram = self.get_histogram("liver")
+            self.kidney_histogram = self.get_histogram("kidney")
+            self.liver_pixels = None
+            self.kidney_pixels = None
+
+    def _set_locations(self, name, locations):
+        # Existing location lists are updated in place: an analyzer on screen edits them through shared references
+        current = getattr(self, name, None)
+        if isinstance(current, list):
+            current[:] = locations
+        else:
+            setattr(self, name, locations)
 
     def create_picture_with_histograms(self, path = None):
         # if not self.liver_pixels or not self.kidney_pixels:
         #     raise ValueError("Pixel data is empty. Ensure 'read_pixels' is called before creating histograms.")
-        self.read_pixels()
-        # Convert pixel data to numpy arrays
-        liver_data = np.array(self.liver_pixels)
-        kidney_data = np.array(self.kidney_pixels)
-
-        # Create histograms
-        fig, axes = plt.subplots(1, 2, figsize=(12, 6), sharey=True)
-
-        axes[0].hist(liver_data, bins=30, color='blue', alpha=0.7)
-        axes[0].set_title("Liver Pixels")
-        axes[0].set_xlabel("Pixel Intensity")
-        axes[0].set_ylabel("Frequency")
-        axes[0].text(0.95, 0.95, f"Mean: {liver_data.mean():.2f}\nStd: {liver_data.std():.2f}",
-                     transform=axes[0].transAxes, ha="right", va="top", fontsize=10,
-                     bbox=dict(facecolor="white", alpha=0.5))
-
-        axes[1].hist(kidney_data, bins=30, color='yellow', alpha=0.7)
-        axes[1].set_title("Kidney Pixels")
-        axes[1].set_xlabel("Pixel Intensity")
-        axes[1].text(0.95, 0.95, f"Mean: {kidney_data.mean():.2f}\nStd: {kidney_data.std():.2f}",
-                     transform=axes[1].transAxes, ha="right", va="top", fontsize=10,
-                     bbox=dict(facecolor="white", alpha=0.5))
-
-        # Adjust layout
-        plt.tight_layout()
-
-        # Save the figure
+        # Histograms are derived from the compact ROI representation (counts per intensity);
+        # the image is only read again if it has not been analyzed yet
+        liver_histogram = self.get_histogram("liver")
+        kidney_histogram = self.get_histogram("kidney")
+        if liver_histogram is None or kidney_histogram is None:
+            self.read_pixels()
+            liver_histogram = self.get_histogram("liver")
+            kidney_histogram = self.get_histogram("kidney")
+
+        # Save the figure (the renderer reuses one pre-laid-out figure per process)
         base_name, _ = os.path.splitext(self.file_name)
         output_path = f"{base_name}_histograms.tif" if path is None else path
-        fig.suptitle(self.file_name)
-        plt.savefig(output_path)
-        plt.close(fig)
+        with profiler.stage("render", self.file_name):
+            from HistogramRenderer import get_renderer  # matplotlib is only loaded when figures are requested
+            get_renderer().render(self.file_name, liver_histogram, kidney_histogram, output_path)
 
         print(f"Histogram figure saved to: {output_path}")
 
@@ -0,0 +1,159 @@
+import os
+import json
+import hashlib
+import sqlite3
+import numpy as np
+
+RESULTS_DATABASE = "LRR_results.sqlite"
+RESULTS_EXCEL = "LRR_results.xlsx"
+
+# Raw pixel lists are never stored, histograms and fingerprints are stored but kept out of the exported workbook
+EXCLUDED_COLUMNS = ("liver_pixels", "kidney_pixels")
+EXCEL_EXCLUDED_COLUMNS = ("liver_histogram", "kidney_histogram", "fingerprint")
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def _json_default(value):
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    if hasattr(value, "to_dict"):  # ROIHistogram
+        return value.to_dict()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def to_stored_value(value):
+    # Lists and dictionaries are stored as JSON (older results hold Python reprs, both are read back)
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    return json.dumps(value, default=_json_default)
+
+
+def image_fingerprint(file_name, liver_locations, kidney_locations, options = None, content_hash = False):
+    # Identifies the inputs of one analysis: the image file (size and modification time, or size and
+    # content hash) and its ROIs, plus any analysis options. Stored results with the same fingerprint
+    # are up to date. None if the file does not exist.
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    if content_hash:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(file_name, "rb") as file:
+            for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        file_key = ["content", stat.st_size, digest.hexdigest()]
+    else:
+        file_key = ["mtime", stat.st_size, stat.st_mtime_ns]
+    rois = [[list(location) for location in liver_locations or []],
+            [list(location) for location in kidney_locations or []]]
+    key = json.dumps([file_key, rois, options or {}], sort_keys=True, default=_json_default)
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def read_excel_rows(excel_path):
+    # Rows of LRR_results.xlsx as dictionaries, empty cells become None
+    import pandas as pd
+    data = pd.read_excel(excel_path)
+    data = data.astype(object).where(data.notna(), None)
+    return [row.to_dict() for _, row in data.iterrows()]
+
+
+def load_records(source):
+    # Image records from a results database, an annotations file, a results workbook, or a folder.
+    # A folder without results yields one record (without ROIs) per .tif file.
+    from HepaticRenalRatioAnnotations import ANNOTATIONS_FILE, load_annotations
+    if os.path.isdir(source):
+        for file_name in (RESULTS_DATABASE, ANNOTATIONS_FILE, RESULTS_EXCEL):
+            if os.path.exists(os.path.join(source, file_name)):
+                source = os.path.join(source, file_name)
+                break
+        else:
+            return [{"file_name": os.path.join(source, f)} for f in sorted(os.listdir(source)) if f.endswith('.tif')]
+    if source.endswith(".json"):
+        return load_annotations(source)
+    if source.endswith(".xlsx"):
+        return read_excel_rows(source)
+    store = ResultsStore(source)
+    try:
+        return store.load_all()
+    finally:
+        store.close()
+
+
+class ResultsStore:
+    # Per-folder results table in an embedded SQLite database, one row per image keyed by file name.
+    # Rows are upserted individually (O(1) per image) and LRR_results.xlsx is only written by export_excel.
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (file_name TEXT PRIMARY KEY)")
+        self.columns = [row[1] for row in self.connection.execute("PRAGMA table_info(results)")]
+
+    @classmethod
+    def for_folder(cls, folder):
+        return cls(os.path.join(folder, RESULTS_DATABASE))
+
+    def _ensure_columns(self, names):
+        # New parameters simply become new columns
+        for name in names:
+            if name not in self.columns:
+                self.connection.execute(f'ALTER TABLE results ADD COLUMN "{name}"')
+                self.columns.append(name)
+
+    def upsert(self, params, commit = True):
+        row = {key: to_stored_value(value) for key, value in params.items() if key not in EXCLUDED_COLUMNS}
+        self._ensure_columns(row)
+        names = ", ".join(f'"{name}"' for name in row)
+        placeholders = ", ".join("?" for _ in row)
+        updates = ", ".join(f'"{name}" = excluded."{name}"' for name in row if name != "file_name")
+        conflict = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+        self.connection.execute(f"INSERT INTO results ({names}) VALUES ({placeholders}) "
+                                f"ON CONFLICT(file_name) {conflict}", list(row.values()))
+        if commit:
+            self.connection.commit()
+
+    def upsert_many(self, params_list):
+        # All rows in one transaction
+        for params in params_list:
+            self.upsert(params, commit = False)
+        self.connection.commit()
+
+    def commit(self):
+        self.connection.commit()
+
+    def delete(self, file_name, commit = True):
+        self.connection.execute("DELETE FROM results WHERE file_name = ?", (file_name,))
+        if commit:
+            self.connection.commit()
+
+    def fingerprints(self):
+        # file_name -> fingerprint of the inputs its stored results were computed from (see image_fingerprint)
+        if "fingerprint" not in self.columns:
+            return {}
+        return dict(self.connection.execute("SELECT file_name, fingerprint FROM results WHERE fingerprint IS NOT NULL"))
+
+    def load_all(self):
+        # Rows as dictionaries (in insertion order), suitable for HepaticRenalRatioImage(params=...)
+        cursor = self.connection.execute("SELECT * FROM results ORDER BY rowid")
+        names = [description[0] for description in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def import_excel(self, excel_path):
+        self.upsert_many(read_excel_rows(excel_path))
+
+    def export_excel(self, excel_path):
+        import pandas as pd
+        data = pd.DataFrame(self.load_all())
+        if data.empty:
+            data = pd.DataFrame(columns=["file_name"])
+        data = data.drop(columns=[c for c in EXCEL_EXCLUDED_COLUMNS if c in data.columns]).set_index('file_name')
+        data.to_excel(excel_path, index=True)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,76 @@
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+HISTOGRAM_BINS = 30
+
+
+class HistogramRenderer:
+    # Renders the liver/kidney histogram figure of create_picture_with_histograms.
+    # The figure, its bars and texts are created once; every image only updates bar geometry, texts
+    # and the title, and lays the figure out again for its tick labels before saving.
+    ORGANS = (("Liver", "blue"), ("Kidney", "yellow"))
+
+    def __init__(self):
+        self.figure = Figure(figsize=(12, 6))
+        FigureCanvasAgg(self.figure)
+        self.axes = self.figure.subplots(1, 2, sharey=True)
+        self.bars = [None, None]
+        self.texts = []
+        for ax, (organ, _) in zip(self.axes, self.ORGANS):
+            ax.set_title(f"{organ} Pixels")
+            ax.set_xlabel("Pixel Intensity")
+            self.texts.append(ax.text(0.95, 0.95, "", transform=ax.transAxes, ha="right", va="top", fontsize=10,
+                                      bbox=dict(facecolor="white", alpha=0.5)))
+        self.axes[0].set_ylabel("Frequency")
+        self.title = None
+
+    @staticmethod
+    def bin_counts(histogram):
+        # 30 equal-width bins between the smallest and largest intensity, computed from the
+        # per-intensity counts (same bins as hist() over the raw pixels)
+        values, counts = histogram.values_and_counts()
+        return np.histogram(values, bins=HISTOGRAM_BINS, weights=counts)
+
+    def _update_axes(self, index, histogram):
+        ax = self.axes[index]
+        heights, edges = self.bin_counts(histogram)
+        if self.bars[index] is None:
+            _, _, self.bars[index] = ax.hist(edges[:-1], bins=edges, weights=heights,
+                                             color=self.ORGANS[index][1], alpha=0.7)
+        else:
+            for bar, left, width, height in zip(self.bars[index], edges[:-1], np.diff(edges), heights):
+                bar.set_x(left)
+                bar.set_width(width)
+                bar.set_height(height)
+            ax.relim()
+            ax.autoscale_view()
+        mean, std = histogram.mean(), histogram.std()
+        self.texts[index].set_text(f"Mean: {np.nan if mean is None else mean:.2f}\n"
+                                   f"Std: {np.nan if std is None else std:.2f}")
+
+    def render(self, title, liver_histogram, kidney_histogram, output_path):
+        self._update_axes(0, liver_histogram)
+        self._update_axes(1, kidney_histogram)
+        if self.title is None:
+            self.title = self.figure.suptitle(title)
+            # Layout leaves the title out (as in the original figure, laid out before the title was added)
+            self.title.set_in_layout(False)
+        else:
+            self.title.set_text(title)
+        # Tick labels (and so the margins) depend on the counts of every image
+        self.figure.tight_layout()
+        self.figure.savefig(output_path)
+        return output_path
+
+
+_renderer = None
+
+
+def get_renderer():
+    # One renderer per process (and per worker process)
+    global _renderer
+    if _renderer is None:
+        _renderer = HistogramRenderer()
+    return _renderer
+
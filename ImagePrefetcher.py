@@ -0,0 +1,61 @@
+import threading
+from DecodedImageCache import image_cache
+
+
+class ImagePrefetcher:
+    # Background thread that decodes (and pre-scales for display) the images around the
+    # selected one into the shared DecodedImageCache, so switching images is a cache hit.
+    # Only the latest request matters: a new selection abandons the previous prefetch.
+    def __init__(self, window = 2, cache = image_cache):
+        self.window = window  # Number of images prefetched on each side of the selection
+        self.cache = cache
+        self._pending = None
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="ImagePrefetcher", daemon=True)
+        self._thread.start()
+
+    def neighbours(self, file_names, index):
+        # Next and previous images alternately, nearest first
+        order = []
+        for distance in range(1, self.window + 1):
+            for neighbour in (index + distance, index - distance):
+                if 0 <= neighbour < len(file_names):
+                    order.append(file_names[neighbour])
+        return order
+
+    def prefetch(self, file_names, index, size = None):
+        # size: (width, height) of the analyzer canvas, or None to only decode
+        with self._condition:
+            self._pending = (self.neighbours(file_names, index), size)
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _superseded(self):
+        with self._condition:
+            return self._stopped or self._pending is not None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                file_names, size = self._pending
+                self._pending = None
+
+            for file_name in file_names:
+                if self._superseded():
+                    break
+                try:
+                    if size is not None:
+                        self.cache.get_scaled(file_name, size)  # Decodes too
+                    else:
+                        self.cache.get_rgb(file_name)
+                except Exception as e:
+                    print(f"Failed to prefetch {file_name}: {e}")
@@ -1,21 +1,53 @@
 import os
+import time
 import tkinter as tk
-from tkinter import filedialog, ttk
-import pandas as pd
+from tkinter import filedialog, messagebox, ttk
 from HepaticRenalRatioAnalyzeGUI import HepaticRenalRatioAnalyzer
-from HepaticRenalRatioImage import HepaticRenalRatioImage
+from HepaticRenalRatioImage import HepaticRenalRatioImage, ANALYSIS_VERSION
+from HepaticRenalRatioBatch import BatchAnalyzer
+from HepaticRenalRatioResults import ResultsStore, image_fingerprint, RESULTS_DATABASE, RESULTS_EXCEL
+from DecodedImageCache import image_cache
+from ImagePrefetcher import ImagePrefetcher
+from HepaticRenalRatioAnnotations import ANNOTATIONS_FILE, load_annotations, save_annotations
+from StageProfiler import profiler
+from ThumbnailCache import ThumbnailCache
+from ThumbnailStrip import ThumbnailStrip
+
+TIMINGS_FILE = "LRR_timings.csv"
+
+# File list colors of images while "Analyze All" is running
+# Cancelled images get their regular color back (see file_color)
+BATCH_STATUS_COLORS = {"queued": "gray", "done": "green", "skipped": "black", "error": "orange"}
 
 class HepaticRenalRatioApp(tk.Tk):
-    def __init__(self):
+    def __init__(self, compact_rois = True, image_cache_mb = None, prefetch_window = 2, profile = False,
+                 hash_contents = False):
         super().__init__()
         self.title("Hepatic Renal Ratio Analyzer")
-        self.geometry("1000x600")
+        self.geometry("1000x800")
 
         self.image_instances = []
         self.current_path = ""
         self.current_file_index = None
         self.current_analyzer = None
+        # Keep ROI pixels as compact histograms rather than Python lists (see ROIHistogram)
+        self.compact_rois = compact_rois
+        if image_cache_mb is not None:
+            image_cache.set_budget(image_cache_mb)
+        # Per-stage timings of Analyze All (also enabled by HRR_PROFILE=1)
+        if profile:
+            profiler.enable()
+        # Analyze All skips images whose file and ROIs are unchanged since their stored results.
+        # Files are compared by size and modification time, or by size and content hash
+        self.hash_contents = hash_contents
+        self.batch_fingerprints = {}
+        # Decodes and pre-scales the neighbours of the selected image in the background
+        self.prefetcher = ImagePrefetcher(window = prefetch_window)
+        self.batch = None
+        self.results = None # ResultsStore of the current folder
+        self.thumbnails = None # ThumbnailCache of the current folder
         self.create_widgets()
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def create_widgets(self):
         # Menu frame
@@ -25,7 +57,21 @@ class HepaticRenalRatioApp(tk.Tk):
         tk.Button(self.menu_frame, text="Choose Path", command=self.choose_path).pack(side=tk.LEFT, padx=5, pady=5)
         self.create_histograms_var = tk.BooleanVar()
         tk.Checkbutton(self.menu_frame, text="Create Histograms", variable=self.create_histograms_var).pack(side=tk.LEFT, padx=5, pady=5)
+        self.multi_frame_var = tk.BooleanVar()
+        tk.Checkbutton(self.menu_frame, text="Cine Loops", variable=self.multi_frame_var).pack(side=tk.LEFT, padx=5, pady=5)
         tk.Button(self.menu_frame, text="Analyze All", command=self.analyze_all).pack(side=tk.LEFT, padx=5, pady=5)
+        tk.Label(self.menu_frame, text="Workers", bg="lightgray").pack(side=tk.LEFT, padx=(5, 0), pady=5)
+        self.workers_var = tk.IntVar(value=os.cpu_count() or 1)
+        tk.Spinbox(self.menu_frame, from_=1, to=64, width=3, textvariable=self.workers_var).pack(side=tk.LEFT, padx=5, pady=5)
+        self.cancel_button = tk.Button(self.menu_frame, text="Cancel", command=self.cancel_analyze_all, state=tk.DISABLED)
+        self.cancel_button.pack(side=tk.LEFT, padx=5, pady=5)
+        self.progress = ttk.Progressbar(self.menu_frame, orient="horizontal", length=200, mode="determinate")
+        self.progress.pack(side=tk.LEFT, padx=5, pady=5)
+        tk.Button(self.menu_frame, text="Export Excel", command=self.export_excel).pack(side=tk.LEFT, padx=5, pady=5)
+
+        # Thumbnails of the folder, loaded as the strip scrolls
+        self.thumbnail_strip = ThumbnailStrip(self, on_select=self.select_file)
+        self.thumbnail_strip.pack(side=tk.BOTTOM, fill=tk.X)
 
         # Main content frame
         self.main_content_frame = tk.Frame(self)
@@ -55,41 +101,83 @@ class HepaticRenalRatioApp(tk.Tk):
         self.current_path = filedialog.askdirectory()
         if not self.current_path:
             return
+        # Results of a running batch belong to the previous folder and are discarded
+        if self.batch is not None:
+            self.batch.cancel()
+            self.batch = None
+            self.cancel_button.config(state=tk.DISABLED)
+            self.progress.config(value=0)
+        # Decoded images of the previous folder are no longer needed
+        image_cache.clear()
 
         self.load_or_create_excel()
         self.populate_file_list()
 
+        if self.thumbnails is not None:
+            self.thumbnails.close()
+        self.thumbnails = ThumbnailCache(self.current_path)
+        self.thumbnails.prune(self.image_instances)
+        self.thumbnail_strip.set_images(self.thumbnails, self.image_instances)
+
     def load_or_create_excel(self):
-        excel_path = os.path.join(self.current_path, "LRR_results.xlsx")
+        # Results are kept in LRR_results.sqlite, LRR_annotations.json/.npz and LRR_results.xlsx are exports of it.
+        # A folder that only has the annotations or the workbook (older versions) is imported once.
+        excel_path = os.path.join(self.current_path, RESULTS_EXCEL)
+        annotations_path = os.path.join(self.current_path, ANNOTATIONS_FILE)
+        database_exists = os.path.exists(os.path.join(self.current_path, RESULTS_DATABASE))
+        if self.results is not None:
+            self.results.close()
+        self.results = ResultsStore.for_folder(self.current_path)
 
-        if os.path.exists(excel_path):
-            data = pd.read_excel(excel_path)
-            # self.image_instances = [HepaticRenalRatioImage(row['file_name']) for _, row in data.iterrows()]
-            self.image_instances = [HepaticRenalRatioImage(file_name = '', params=row) for _, row in data.iterrows()]
+        if not database_exists and os.path.exists(annotations_path):
+            self.results.upsert_many(load_annotations(annotations_path))
+        elif not database_exists and os.path.exists(excel_path):
+            self.results.import_excel(excel_path)
 
-        else:
-            tif_files = [f for f in os.listdir(self.current_path) if f.endswith('.tif')]
-            self.image_instances = [HepaticRenalRatioImage(os.path.join(self.current_path, f)) for f in tif_files]
+        new_folder = len(self.results) == 0
+        self.image_instances = [HepaticRenalRatioImage(file_name = '', params=row, compact=self.compact_rois) for row in self.results.load_all()]
+        if self.sync_folder() or new_folder:
+            self.results.export_excel(excel_path)
 
-            data = pd.DataFrame([i.get_parameters() for i in self.image_instances]).set_index('file_name')
-            data.to_excel(excel_path, index=True)
-            # Following the cration of an excel, load it.
-            self.load_or_create_excel()
+    def sync_folder(self):
+        # Adds the .tif files that are not in the results yet and drops the results of deleted files.
+        # Returns True if anything changed.
+        tif_files = sorted(f for f in os.listdir(self.current_path) if f.endswith('.tif'))
+        removed = [img for img in self.image_instances if not os.path.exists(img.file_name)
+                   and os.path.basename(img.file_name) not in tif_files]
+        known = {os.path.basename(img.file_name) for img in self.image_instances}
+        added = [HepaticRenalRatioImage(os.path.join(self.current_path, f), compact=self.compact_rois)
+                 for f in tif_files if f not in known]
+
+        for img in removed:
+            self.results.delete(img.file_name, commit = False)
+        self.results.upsert_many(img.get_parameters() for img in added)
+        self.image_instances = [img for img in self.image_instances if img not in removed] + added
+        if added or removed:
+            print(f"{len(added)} new and {len(removed)} removed images in {self.current_path}")
+        return bool(added or removed)
 
     def populate_file_list(self):
         self.file_listbox.delete(0, tk.END)
 
         for img in self.image_instances:
-            color = "black"
-            if not img.liver_locations or not img.kidney_locations:
-                color = "black"
-            elif img.liver_mean is None or img.kidney_mean is None:
-                color = "red"
-            else:
-                color = "green"
-
             self.file_listbox.insert(tk.END, os.path.basename(img.file_name))
-            self.file_listbox.itemconfig(tk.END, fg=color)
+            self.file_listbox.itemconfig(tk.END, fg=self.file_color(img))
+
+    @staticmethod
+    def file_color(img):
+        if not img.liver_locations or not img.kidney_locations:
+            return "black"
+        elif img.liver_mean is None or img.kidney_mean is None:
+            return "red"
+        return "green"
+
+    def select_file(self, index):
+        # Selects an image from the thumbnail strip
+        self.file_listbox.selection_clear(0, tk.END)
+        self.file_listbox.selection_set(index)
+        self.file_listbox.see(index)
+        self.on_file_select(None)
 
     def on_file_select(self, event):
         selection = self.file_listbox.curselection()
@@ -99,25 +187,57 @@ class HepaticRenalRatioApp(tk.Tk):
         index = selection[0]
         if self.current_file_index is not None:
             self.update_excel()
+            # Its ROIs may have been edited
+            self.thumbnail_strip.refresh(self.current_file_index)
             # Delete circles on screen
 
 
         self.current_file_index = index
+        # Canvas size of the analyzer on screen, the next one will have the same size
+        display_size = None
+        if self.current_analyzer is not None and self.current_analyzer.displayed_size is not None:
+            display_size = self.current_analyzer.displayed_size[:2]
         self.display_analyzer(self.image_instances[index])
+        self.thumbnail_strip.select(index)
+        self.prefetcher.prefetch([img.file_name for img in self.image_instances], index, display_size)
 
-    def update_excel(self, index = None):
+    def update_excel(self, index = None, commit = True, fingerprint = None):
+        # Saves a single image to the results store. The workbook itself is written by export_excel.
+        # The fingerprint is only given for freshly computed results (see analyze_all)
         if self.current_file_index is None and index is None:
             return
         if index is None:
             index = self.current_file_index
 
-        excel_path = os.path.join(self.current_path, "LRR_results.xlsx")
-        data = pd.read_excel(excel_path).set_index('file_name')
         img = self.image_instances[index]
-        img_dic = img.get_parameters()
-        img_dic = dict((i, img_dic[i]) for i in img_dic if i not in ['file_name', 'kidney_pixels','liver_pixels']) # remove index..
-        data.loc[img.file_name] = img_dic
-        data.to_excel(excel_path, index=True)
+        params = img.get_parameters()
+        if fingerprint is not None:
+            params["fingerprint"] = fingerprint
+        self.results.upsert(params, commit = commit)
+
+    def export_excel(self):
+        if self.results is None:
+            return
+        self.update_excel()
+        self.results.export_excel(os.path.join(self.current_path, RESULTS_EXCEL))
+        save_annotations(self.current_path, self.results.load_all())
+
+    def on_close(self):
+        self.prefetcher.stop()
+        self.thumbnail_strip.close()
+        if self.thumbnails is not None:
+            self.thumbnails.close()
+        if self.batch is not None:
+            self.batch.cancel()
+        # The results stay in the database if the workbook cannot be written (e.g. it is open elsewhere)
+        try:
+            self.export_excel()
+        except Exception as e:
+            print(f"Failed to export the results: {e}")
+        finally:
+            if self.results is not None:
+                self.results.close()
+            self.destroy()
 
     def display_analyzer(self, image_instance):
         if isinstance(image_instance, HepaticRenalRatioImage) and self.current_analyzer and image_instance is self.current_analyzer.hrr_image:
@@ -133,17 +253,85 @@ class HepaticRenalRatioApp(tk.Tk):
             self.current_analyzer.toggle_mode()
 
     def analyze_all(self):
+        if self.batch is not None or not self.image_instances:
+            return # A batch is already running
         results_path = os.path.join(self.current_path, "results")
         os.makedirs(results_path, exist_ok=True)
 
+        # Save the ROIs of the image on screen, workers read them from the instances
+        self.update_excel()
+        multi_frame = self.multi_frame_var.get()
+        stored_fingerprints = self.results.fingerprints()
+        self.batch_fingerprints = {}
+        jobs = []
         for img_index, img in enumerate(self.image_instances):
-            flag = img.read_pixels() # None / False if no locations are chosen for both liver and kidney
-
-            if flag and self.create_histograms_var.get():
+            histogram_path = None
+            if self.create_histograms_var.get():
                 histogram_path = os.path.join(results_path, f"{os.path.basename(img.file_name)}_histogram.png")
-                img.create_picture_with_histograms(path = histogram_path)
-            self.update_excel(index = img_index)
-        self.populate_file_list()
+            fingerprint = image_fingerprint(img.file_name, img.liver_locations, img.kidney_locations,
+                                            {"multi_frame": multi_frame, "version": ANALYSIS_VERSION},
+                                            content_hash=self.hash_contents)
+            # An interval cleared by an interactive analysis is only filled in again by a batch worker
+            has_interval = img.hepatic_renal_ratio is None or img.hepatic_renal_ratio_ci_low is not None
+            if (fingerprint is not None and stored_fingerprints.get(img.file_name) == fingerprint and has_interval
+                    and (histogram_path is None or os.path.exists(histogram_path))):
+                continue # Unchanged since the stored results
+            self.batch_fingerprints[img_index] = fingerprint
+            params = {"file_name": img.file_name, "liver_locations": list(img.liver_locations),
+                      "kidney_locations": list(img.kidney_locations)}
+            jobs.append((img_index, params, histogram_path))
+            self.file_listbox.itemconfig(img_index, fg=BATCH_STATUS_COLORS["queued"])
+        if not jobs:
+            print(f"All {len(self.image_instances)} images are up to date")
+            return
+        print(f"Analyzing {len(jobs)} of {len(self.image_instances)} images, the others are up to date")
+
+        profiler.clear()
+        self.batch_start_time = time.perf_counter()
+        self.batch = BatchAnalyzer(workers=self.workers_var.get(), multi_frame=multi_frame)
+        self.progress.config(maximum=len(jobs), value=0)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.batch.start(jobs)
+        self.after(100, self.poll_analyze_all, self.batch)
+
+    def poll_analyze_all(self, batch):
+        if batch is not self.batch:
+            return # Abandoned when another folder was opened
+        for img_index, status, result in self.batch.poll():
+            if status in ("done", "skipped"):
+                # Only statistics are taken from the worker, the ROI lists may be edited on screen meanwhile
+                img = self.image_instances[img_index]
+                result = dict(result, liver_locations=img.liver_locations, kidney_locations=img.kidney_locations)
+                img.load_from_dictionary(result)
+                with profiler.stage("store", img.file_name):
+                    self.update_excel(index = img_index, commit = False, fingerprint = self.batch_fingerprints.get(img_index))
+            elif status == "error":
+                print(f"Failed to analyze {self.image_instances[img_index].file_name}: {result}")
+            color = BATCH_STATUS_COLORS.get(status) or self.file_color(self.image_instances[img_index])
+            self.file_listbox.itemconfig(img_index, fg=color)
+        self.results.commit() # One transaction per poll
+        self.progress.config(value=self.batch.completed)
+
+        if self.batch.done:
+            profiler.add_rows(self.batch.stage_rows)
+            self.batch = None
+            self.cancel_button.config(state=tk.DISABLED)
+            try:
+                with profiler.stage("export"):
+                    self.export_excel()
+            except Exception as e:
+                messagebox.showerror("Export failed", f"The results are saved in {RESULTS_DATABASE}, but could not be exported: {e}")
+            if profiler.enabled:
+                profiler.write_log(os.path.join(self.current_path, TIMINGS_FILE))
+                print(f"Analyze All finished in {time.perf_counter() - self.batch_start_time:.1f}s")
+                print(profiler.summary())
+        else:
+            self.after(100, self.poll_analyze_all, batch)
+
+    def cancel_analyze_all(self):
+        if self.batch is not None:
+            self.batch.cancel()
+            self.cancel_button.config(state=tk.DISABLED)
 
 if __name__ == "__main__":
     app = HepaticRenalRatioApp()
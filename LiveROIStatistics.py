@@ -0,0 +1,96 @@
+import numpy as np
+from ROIMaskEngine import OVERLAP_POLICIES, default_mask_engine
+
+
+class LiveROIStatistics:
+    # Interactive ROI statistics for one grayscale image. Per-row cumulative sums of the intensity
+    # and squared intensity are computed once; the sum over any horizontal span is then a difference
+    # of two prefix sums, so an organ's mean/std costs O(total ellipse height) instead of O(area).
+    def __init__(self, gray, mask_engine = default_mask_engine):
+        self.shape = gray.shape[:2]
+        self.mask_engine = mask_engine
+        height, width = self.shape
+        # 8-bit rows fit in int32 (255 * width, and 255 ** 2 * width up to 33000 columns), half the memory of int64
+        sum_type = np.int32
+        square_type = np.int32 if 255 ** 2 * width < 2 ** 31 else np.int64
+        self.row_sums = np.zeros((height, width + 1), dtype=sum_type)
+        self.row_square_sums = np.zeros((height, width + 1), dtype=square_type)
+        np.cumsum(gray, axis=1, dtype=sum_type, out=self.row_sums[:, 1:])
+        np.cumsum(gray.astype(square_type) ** 2, axis=1, out=self.row_square_sums[:, 1:])
+
+    def _union_spans(self, locations):
+        # Row spans of all ellipses of an organ, merged so overlapping pixels are counted once
+        # (same pixels as the OR-ed organ mask of read_pixels)
+        spans = list(self.mask_engine.row_spans(self.shape, locations))
+        if not spans:
+            return None
+        rows, first, last = (np.concatenate(parts) for parts in zip(*spans))
+        # Spans are placed on one line, rows separated by a gap, and merged with a running maximum
+        stride = self.shape[1] + 2
+        starts = rows * stride + first
+        ends = rows * stride + last
+        order = np.argsort(starts, kind="stable")
+        starts, ends = starts[order], ends[order]
+        running_end = np.maximum.accumulate(ends)
+        new_span = np.ones(len(starts), dtype=bool)
+        new_span[1:] = starts[1:] > running_end[:-1]
+        group_end = np.append(np.flatnonzero(new_span)[1:] - 1, len(starts) - 1)
+        merged_starts, merged_ends = starts[new_span], running_end[group_end]
+        rows = merged_starts // stride
+        return rows, merged_starts - rows * stride, merged_ends - rows * stride
+
+    def organ_statistics(self, locations):
+        # (pixel count, mean, std) of the union of the ellipses, (0, None, None) if empty
+        spans = self._union_spans(locations)
+        if spans is None:
+            return 0, None, None
+        rows, first, last = spans
+        count = int(np.sum(last - first + 1))
+        if count == 0:
+            return 0, None, None
+        total = np.sum(self.row_sums[rows, last + 1] - self.row_sums[rows, first], dtype=np.int64)
+        square_total = np.sum(self.row_square_sums[rows, last + 1] - self.row_square_sums[rows, first], dtype=np.int64)
+        mean = total / count
+        return count, mean, np.sqrt(max(square_total / count - mean ** 2, 0.0))
+
+    def _span_totals(self, rows, first, last):
+        # (pixel count, intensity sum) of the given row spans
+        count = int(np.sum(last - first + 1))
+        total = np.sum(self.row_sums[rows, last + 1] - self.row_sums[rows, first], dtype=np.int64)
+        return count, total
+
+    def roi_means(self, locations, overlap = "first"):
+        # Mean of every ellipse over the pixels it owns where ellipses overlap (first or last ellipse wins),
+        # the same pixels as the label map of read_pixels (see ROIMaskEngine.build_label_map). None if empty
+        if overlap not in OVERLAP_POLICIES:
+            raise ValueError(f"Unknown overlap policy '{overlap}', expected one of {OVERLAP_POLICIES}")
+        means = []
+        for index, location in enumerate(locations):
+            own = next(self.mask_engine.row_spans(self.shape, [location]), None)
+            if own is None:
+                means.append(None)
+                continue
+            count, total = self._span_totals(*own)
+            # Pixels also inside an ellipse that owns them instead
+            others = self._union_spans(locations[:index] if overlap == "first" else locations[index + 1:])
+            if others is not None:
+                rows, first, last = others
+                own_first = np.zeros(self.shape[0], dtype=np.int64)
+                own_last = np.full(self.shape[0], -1, dtype=np.int64)
+                own_first[own[0]], own_last[own[0]] = own[1], own[2]
+                first, last = np.maximum(first, own_first[rows]), np.minimum(last, own_last[rows])
+                shared = first <= last
+                shared_count, shared_total = self._span_totals(rows[shared], first[shared], last[shared])
+                count -= shared_count
+                total -= shared_total
+            means.append(total / count if count > 0 else None)
+        return means
+
+    def hepatic_renal_ratio(self, liver_locations, kidney_locations):
+        # (liver mean, kidney mean, hepatic-renal ratio); None where not available
+        _, liver_mean, _ = self.organ_statistics(liver_locations)
+        _, kidney_mean, _ = self.organ_statistics(kidney_locations)
+        ratio = None
+        if liver_mean is not None and kidney_mean is not None and kidney_mean > 0:
+            ratio = liver_mean / kidney_mean
+        return liver_mean, kidney_mean, ratio
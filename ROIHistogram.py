@@ -0,0 +1,100 @@
+import ast
+import json
+import numpy as np
+
+
+class ROIHistogram:
+    # Compact representation of the pixel intensities inside an ROI:
+    # a fixed-size count histogram (256 bins for 8-bit images, 65536 for 16-bit) plus moments.
+    # Mean, std and percentiles are derived from the counts, so the raw pixel list is not kept.
+    def __init__(self, counts):
+        self.counts = np.asarray(counts, dtype=np.int64)
+        values = np.arange(len(self.counts), dtype=np.float64)
+        self.count = int(self.counts.sum())
+        self.sum = np.dot(self.counts, values)
+        self.sum_squares = np.dot(self.counts, values ** 2)
+
+    @staticmethod
+    def bins_for(pixels):
+        pixels = np.asarray(pixels)
+        if pixels.dtype == np.uint8 or pixels.size == 0 or pixels.max() < 256:
+            return 256
+        return 65536
+
+    @classmethod
+    def from_pixels(cls, pixels, bins=None):
+        pixels = np.asarray(pixels)
+        if bins is None:
+            bins = cls.bins_for(pixels)
+        return cls(np.bincount(pixels.ravel().astype(np.intp, copy=False), minlength=bins))
+
+    @classmethod
+    def from_labels(cls, pixels, labels, label_count, bins=None):
+        # One histogram per label 1..label_count of a label map (see ROIMaskEngine.build_label_map) over pixels
+        # of the same shape, all counted by a single bincount over the labelled pixels
+        pixels = np.asarray(pixels)
+        if bins is None:
+            bins = cls.bins_for(pixels)
+        inside = labels > 0
+        keys = (labels[inside].astype(np.intp) - 1) * bins + pixels[inside]
+        counts = np.bincount(keys, minlength=label_count * bins).reshape(label_count, bins)
+        return [cls(row) for row in counts]
+
+    @classmethod
+    def pooled(cls, histograms):
+        # Histogram of the union of ROIs that share no pixels
+        return cls(np.sum([histogram.counts for histogram in histograms], axis=0))
+
+    @classmethod
+    def from_dict(cls, data):
+        # Inverse of to_dict. Strings are accepted: JSON, or the dictionary repr written by older versions
+        if isinstance(data, str):
+            try:
+                data = json.loads(data)
+            except ValueError:
+                data = ast.literal_eval(data)
+        counts = np.zeros(data["bins"], dtype=np.int64)
+        counts[np.asarray(data["values"], dtype=np.intp)] = data["counts"]
+        return cls(counts)
+
+    def to_dict(self):
+        # Sparse form, only non-empty bins are stored
+        values = np.flatnonzero(self.counts)
+        return {"bins": len(self.counts), "values": values.tolist(), "counts": self.counts[values].tolist()}
+
+    def values_and_counts(self):
+        # Non-empty bins only, suitable for plt.hist(values, weights=counts)
+        values = np.flatnonzero(self.counts)
+        return values, self.counts[values]
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.sum / self.count
+
+    def std(self):
+        # Population standard deviation (same as np.std), computed around the mean to avoid cancellation
+        if self.count == 0:
+            return None
+        values, counts = self.values_and_counts()
+        return np.sqrt(np.dot(counts, (values - self.mean()) ** 2) / self.count)
+
+    def percentile(self, q):
+        # Same result as np.percentile(pixels, q) with the default linear interpolation
+        if self.count == 0:
+            return None
+        values, counts = self.values_and_counts()
+        cumulative = np.cumsum(counts)
+        position = np.asarray(q, dtype=np.float64) / 100 * (self.count - 1)
+        lower = np.floor(position)
+        lower_value = values[np.searchsorted(cumulative, lower, side="right")]
+        upper_value = values[np.searchsorted(cumulative, np.minimum(lower + 1, self.count - 1), side="right")]
+        result = lower_value + (upper_value - lower_value) * (position - lower)
+        return result if result.ndim else result[()]
+
+    def to_pixels(self):
+        # Pixel values sorted by intensity (the original scan order is not kept)
+        return np.repeat(np.arange(len(self.counts)), self.counts)
+
+    def __len__(self):
+        return self.count
@@ -0,0 +1,143 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Owner of pixels inside several ellipses of an organ in build_label_map
+OVERLAP_POLICIES = ("first", "last")
+
+
+class ROIMaskEngine:
+    # Rasterizes elliptical ROIs (x, y, x-radius, y-radius) into boolean masks.
+    # Every ellipse is only evaluated inside its own bounding box, and the boolean
+    # stencil of an ellipse depends on its radii alone (for integer centers), so
+    # stencils are cached by (x_radius, y_radius) and reused between ROIs and images.
+    def __init__(self, max_stencils=256):
+        self.max_stencils = max_stencils
+        self._stencils = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _rasterize(x_offset, y_offset, x_radius, y_radius):
+        # Same inequality as the original full-frame evaluation, restricted to the
+        # bounding box. Offsets are the sub-pixel part of the center (0 for integer centers).
+        half_width = int(np.ceil(abs(x_radius) + abs(x_offset)))
+        half_height = int(np.ceil(abs(y_radius) + abs(y_offset)))
+        y_grid, x_grid = np.ogrid[-half_height:half_height + 1, -half_width:half_width + 1]
+        return (((x_grid - x_offset) / x_radius) ** 2 + ((y_grid - y_offset) / y_radius) ** 2) <= 1
+
+    @staticmethod
+    def _is_valid_radius(radius):
+        return np.isfinite(radius) and radius != 0
+
+    def stencil(self, x_radius, y_radius):
+        key = (x_radius, y_radius)
+        with self._lock:
+            stencil = self._stencils.get(key)
+            if stencil is not None:
+                self._stencils.move_to_end(key)
+                return stencil
+
+        stencil = self._rasterize(0, 0, x_radius, y_radius)
+        stencil.setflags(write=False)  # Shared between callers, never modify in place
+        with self._lock:
+            self._stencils[key] = stencil
+            self._stencils.move_to_end(key)
+            while len(self._stencils) > self.max_stencils:
+                self._stencils.popitem(last=False)
+        return stencil
+
+    def clear(self):
+        with self._lock:
+            self._stencils.clear()
+
+    def clipped_stencils(self, shape, locations):
+        # Yields (row slice, column slice, stencil view) for every ellipse, clipped to an
+        # image of the given shape. Ellipses fully outside the image are skipped.
+        height, width = shape[:2]
+        for x, y, x_radius, y_radius in locations:
+            if not (self._is_valid_radius(x_radius) and self._is_valid_radius(y_radius)):
+                continue  # Degenerate ellipse, contains no pixels
+            x_center, y_center = int(np.floor(x)), int(np.floor(y))
+            if x == x_center and y == y_center:
+                stencil = self.stencil(x_radius, y_radius)
+            else:
+                # Sub-pixel centers (not produced by the GUI) are rasterized without caching
+                stencil = self._rasterize(x - x_center, y - y_center, x_radius, y_radius)
+
+            y0 = y_center - stencil.shape[0] // 2
+            x0 = x_center - stencil.shape[1] // 2
+            y1, x1 = y0 + stencil.shape[0], x0 + stencil.shape[1]
+            clip_y0, clip_x0 = max(y0, 0), max(x0, 0)
+            clip_y1, clip_x1 = min(y1, height), min(x1, width)
+            if clip_y0 >= clip_y1 or clip_x0 >= clip_x1:
+                continue
+            yield (slice(clip_y0, clip_y1), slice(clip_x0, clip_x1),
+                   stencil[clip_y0 - y0:clip_y1 - y0, clip_x0 - x0:clip_x1 - x0])
+
+    @staticmethod
+    def _inside(dx, dy, x_radius, y_radius):
+        # dx, dy: offsets from the (sub-pixel) center, same inequality as _rasterize
+        return ((dx / x_radius) ** 2 + (dy / y_radius) ** 2) <= 1
+
+    def row_spans(self, shape, locations):
+        # For every ellipse, yields (rows, first columns, last columns) of its pixels, clipped to an image
+        # of the given shape. Ellipses are convex, so each row is one span; spans are computed per row
+        # (O(ellipse height)) and match the rasterized stencils exactly.
+        height, width = shape[:2]
+        for x, y, x_radius, y_radius in locations:
+            if not (self._is_valid_radius(x_radius) and self._is_valid_radius(y_radius)):
+                continue
+            x_center, y_center = int(np.floor(x)), int(np.floor(y))
+            x_offset, y_offset = x - x_center, y - y_center
+            half_height = int(np.ceil(abs(y_radius) + abs(y_offset)))
+            dy = np.arange(-half_height, half_height + 1)
+            dy = dy[(y_center + dy >= 0) & (y_center + dy < height)]
+            dy_offset = dy - y_offset
+
+            # Analytic half width, then nudged by whole pixels so the edges agree with the inequality
+            half_width = abs(x_radius) * np.sqrt(np.clip(1 - (dy_offset / y_radius) ** 2, 0, None))
+            first = np.ceil(x_offset - half_width).astype(np.int64)
+            last = np.floor(x_offset + half_width).astype(np.int64)
+            for _ in range(2):
+                first -= self._inside(first - 1 - x_offset, dy_offset, x_radius, y_radius)
+                last += self._inside(last + 1 - x_offset, dy_offset, x_radius, y_radius)
+                first += ~self._inside(first - x_offset, dy_offset, x_radius, y_radius) & (first <= last)
+                last -= ~self._inside(last - x_offset, dy_offset, x_radius, y_radius) & (first <= last)
+
+            first = np.maximum(first + x_center, 0)
+            last = np.minimum(last + x_center, width - 1)
+            keep = first <= last
+            if keep.any():
+                yield (y_center + dy)[keep], first[keep], last[keep]
+
+    def build_mask(self, shape, locations):
+        # Union of all ellipses as a boolean image of the given shape
+        mask = np.zeros(shape[:2], dtype=bool)
+        for rows, columns, stencil in self.clipped_stencils(shape, locations):
+            mask[rows, columns] |= stencil
+        return mask
+
+    def build_label_map(self, shape, locations, overlap = "first"):
+        # (row slice, column slice, labels): integer labels over the bounding box of all ellipses, holding the
+        # (1-based) index of the ellipse each pixel belongs to and 0 outside all of them. A pixel inside several
+        # ellipses belongs to the first or the last of them (overlap policy), so the labelled pixels are exactly
+        # those of build_mask and every pixel is counted once.
+        if overlap not in OVERLAP_POLICIES:
+            raise ValueError(f"Unknown overlap policy '{overlap}', expected one of {OVERLAP_POLICIES}")
+        stencils = [(label, rows, columns, stencil) for label, location in enumerate(locations, start=1)
+                    for rows, columns, stencil in self.clipped_stencils(shape, [location])]
+        if not stencils:
+            return slice(0, 0), slice(0, 0), np.zeros((0, 0), dtype=np.uint8)
+        top = min(rows.start for _, rows, _, _ in stencils)
+        left = min(columns.start for _, _, columns, _ in stencils)
+        bottom = max(rows.stop for _, rows, _, _ in stencils)
+        right = max(columns.stop for _, _, columns, _ in stencils)
+        labels = np.zeros((bottom - top, right - left), dtype=np.uint8 if len(locations) < 256 else np.int32)
+        for label, rows, columns, stencil in stencils:
+            region = labels[rows.start - top:rows.stop - top, columns.start - left:columns.stop - left]
+            np.copyto(region, label, where=stencil if overlap == "last" else stencil & (region == 0))
+        return slice(top, bottom), slice(left, right), labels
+
+
+# Process-wide engine, so stencils are shared by all images analyzed in this process
+default_mask_engine = ROIMaskEngine()
@@ -0,0 +1,38 @@
+import numpy as np
+
+ROI_PERCENTILES = (5, 25, 50, 75, 95)
+# ROIs whose mean has a modified z-score above this are flagged (Iglewicz and Hoaglin)
+OUTLIER_THRESHOLD = 3.5
+MIN_ROIS_FOR_OUTLIERS = 3
+
+
+def flag_outliers(means):
+    # Outlier flags of the ROI means of one organ, by the modified z-score 0.6745 * |mean - median| / MAD.
+    # Organs with fewer than MIN_ROIS_FOR_OUTLIERS ROIs, and empty ROIs (None), are never flagged
+    values = np.array([np.nan if mean is None else mean for mean in means], dtype=np.float64)
+    valid = ~np.isnan(values)
+    if valid.sum() < MIN_ROIS_FOR_OUTLIERS:
+        return [False] * len(values)
+    median = np.median(values[valid])
+    mad = np.median(np.abs(values[valid] - median))
+    if mad == 0:
+        return [False] * len(values)
+    scores = 0.6745 * np.abs(values - median) / mad
+    return [bool(is_valid and score > OUTLIER_THRESHOLD) for is_valid, score in zip(valid, scores)]
+
+
+def roi_statistics(histograms):
+    # Per-ROI pixel count, mean, std, percentiles and outlier flag, one dictionary per ROIHistogram
+    rows = []
+    for histogram in histograms:
+        row = {"count": histogram.count, "mean": None, "std": None}
+        row.update({f"p{q}": None for q in ROI_PERCENTILES})
+        if histogram.count > 0:
+            row["mean"] = float(histogram.mean())
+            row["std"] = float(histogram.std())
+            for q, value in zip(ROI_PERCENTILES, histogram.percentile(ROI_PERCENTILES)):
+                row[f"p{q}"] = float(value)
+        rows.append(row)
+    for row, outlier in zip(rows, flag_outliers([row["mean"] for row in rows])):
+        row["outlier"] = outlier
+    return rows
@@ -0,0 +1,96 @@
+import os
+import csv
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+PROFILE_ENVIRONMENT_VARIABLE = "HRR_PROFILE"
+_NULL_STAGE = nullcontext()
+
+
+class _Stage:
+    # Wall time and bytes allocated (peak above the starting level) of one stage of one image
+    def __init__(self, profiler, name, image):
+        self.profiler = profiler
+        self.name = name
+        self.image = image
+
+    def __enter__(self):
+        if self.profiler.track_memory:
+            self.start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start_time
+        allocated = None
+        if self.profiler.track_memory:
+            allocated = max(tracemalloc.get_traced_memory()[1] - self.start_memory, 0)
+        self.profiler.rows.append((self.image, self.name, elapsed, allocated))
+        return False
+
+
+class StageProfiler:
+    # Per-image, per-stage timing (decode, mask, statistics, render, store, ...).
+    # Enabled with HRR_PROFILE=1 (inherited by worker processes) or enable(); when disabled,
+    # stage() returns a shared no-op context manager.
+    def __init__(self, enabled = None, track_memory = True):
+        self.rows = []  # (image, stage, seconds, allocated bytes)
+        self.enabled = False
+        self.track_memory = False
+        if enabled is None:
+            enabled = os.environ.get(PROFILE_ENVIRONMENT_VARIABLE, "") not in ("", "0")
+        if enabled:
+            self.enable(track_memory)
+
+    def enable(self, track_memory = True):
+        self.enabled = True
+        self.track_memory = track_memory
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # Worker processes started from now on profile too
+        os.environ[PROFILE_ENVIRONMENT_VARIABLE] = "1"
+
+    def stage(self, name, image = None):
+        # with profiler.stage("decode", file_name): ...  (image None for batch-level stages)
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name, image)
+
+    def pop_image_rows(self, image):
+        # Rows of one image, removed from this profiler (workers send them back with the result)
+        rows = [row for row in self.rows if row[0] == image]
+        self.rows = [row for row in self.rows if row[0] != image]
+        return rows
+
+    def add_rows(self, rows):
+        self.rows.extend(tuple(row) for row in rows)
+
+    def clear(self):
+        self.rows = []
+
+    def write_log(self, path):
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["image", "stage", "seconds", "allocated_bytes"])
+            writer.writerows(self.rows)
+
+    def summary(self):
+        # Table of per-stage totals, means, 95th percentiles and largest allocation
+        stages = {}
+        for _, stage, seconds, allocated in self.rows:
+            stages.setdefault(stage, []).append((seconds, allocated or 0))
+        total_time = sum(seconds for _, _, seconds, _ in self.rows) or 1
+        lines = [f"{'stage':20s} {'count':>7s} {'total s':>9s} {'mean ms':>9s} {'p95 ms':>9s} {'max MB':>8s} {'share':>6s}"]
+        for stage, values in sorted(stages.items(), key=lambda item: -sum(v[0] for v in item[1])):
+            times = sorted(seconds for seconds, _ in values)
+            p95 = times[min(len(times) - 1, int(0.95 * len(times)))]
+            total = sum(times)
+            lines.append(f"{stage:20s} {len(times):7d} {total:9.2f} {total / len(times) * 1000:9.2f} {p95 * 1000:9.2f} "
+                         f"{max(a for _, a in values) / 2 ** 20:8.1f} {total / total_time:6.1%}")
+        return "\n".join(lines)
+
+
+# Process-wide profiler
+profiler = StageProfiler()
@@ -0,0 +1,113 @@
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from HepaticRenalRatioResults import image_fingerprint
+
+THUMBNAIL_FOLDER = ".hrr_thumbnails"
+THUMBNAIL_SIZE = 160  # Longest side, in pixels
+THUMBNAIL_WORKERS = min(4, os.cpu_count() or 1)
+# ROI overlay colors (BGR), same as the analyzer
+ROI_COLORS = {"liver": (255, 0, 0), "kidney": (0, 255, 255)}
+
+
+def render_thumbnail(file_name, liver_locations, kidney_locations, output_path, size = THUMBNAIL_SIZE):
+    # Downscaled copy of the image with its ROIs drawn in, written atomically as JPEG. Returns output_path
+    import cv2
+    image = cv2.imread(file_name, cv2.IMREAD_COLOR)
+    if image is None:
+        raise FileNotFoundError(f"Image file '{file_name}' not found.")
+    scale = min(1.0, size / max(image.shape[:2]))
+    thumbnail = cv2.resize(image, (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale))),
+                           interpolation=cv2.INTER_AREA)
+    for organ, locations in (("liver", liver_locations), ("kidney", kidney_locations)):
+        for x, y, x_radius, y_radius in locations or []:
+            cv2.ellipse(thumbnail, (round(x * scale), round(y * scale)),
+                        (max(1, round(abs(x_radius) * scale)), max(1, round(abs(y_radius) * scale))),
+                        0, 0, 360, ROI_COLORS[organ], 1, cv2.LINE_AA)
+    temporary_path = f"{output_path}.tmp.jpg"
+    if not cv2.imwrite(temporary_path, thumbnail, [cv2.IMWRITE_JPEG_QUALITY, 85]):
+        raise IOError(f"Could not write '{output_path}'.")
+    os.replace(temporary_path, output_path)
+    return output_path
+
+
+class ThumbnailCache:
+    # Persistent thumbnails of a folder in <folder>/.hrr_thumbnails, one JPEG per image named after the
+    # hash of its path, modification time and ROIs, so editing the ROIs or the file gives a new thumbnail.
+    # Missing thumbnails are rendered by a thread pool (OpenCV releases the GIL while decoding and resizing);
+    # only the most recently requested images are rendered, finished ones are collected with poll().
+    def __init__(self, folder, size = THUMBNAIL_SIZE, workers = THUMBNAIL_WORKERS):
+        self.folder = os.path.join(folder, THUMBNAIL_FOLDER)
+        self.size = size
+        os.makedirs(self.folder, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Thumbnail")
+        self.pending = {}  # key -> (path, future)
+        self.results = queue.Queue()
+
+    def path_for(self, img):
+        # Cache path of the thumbnail of a HepaticRenalRatioImage, None if the file does not exist
+        fingerprint = image_fingerprint(img.file_name, img.liver_locations, img.kidney_locations,
+                                        {"path": os.path.abspath(img.file_name), "thumbnail": self.size})
+        return None if fingerprint is None else os.path.join(self.folder, f"{fingerprint}.jpg")
+
+    def request(self, images):
+        # images: {key: HepaticRenalRatioImage} of the thumbnails currently needed. Returns {key: path} of
+        # those already on disk; the others are rendered in the background, and earlier requests that are
+        # no longer needed and have not started are dropped.
+        for key in list(self.pending):
+            if key not in images and self.pending[key][1].cancel():
+                del self.pending[key]
+        ready = {}
+        for key, img in images.items():
+            path = self.path_for(img)
+            if path is None:
+                continue
+            if os.path.exists(path):
+                ready[key] = path
+            elif key not in self.pending or self.pending[key][0] != path:
+                # New image, or its file or ROIs changed since it was requested
+                if key in self.pending:
+                    self.pending[key][1].cancel()
+                future = self.executor.submit(render_thumbnail, img.file_name, list(img.liver_locations),
+                                              list(img.kidney_locations), path, self.size)
+                future.add_done_callback(lambda f, key = key, path = path: self._on_done(key, path, f))
+                self.pending[key] = (path, future)
+        return ready
+
+    def _on_done(self, key, path, future):
+        # Called from a worker thread; only hands the result over to poll()
+        if future.cancelled():
+            return
+        try:
+            future.result()
+            self.results.put((key, path, True))
+        except Exception as e:
+            print(f"Failed to create thumbnail {path}: {e}")
+            self.results.put((key, path, False))
+
+    def poll(self):
+        # (key, path or None) of the thumbnails rendered since the last call
+        completed = []
+        while True:
+            try:
+                key, path, success = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if key in self.pending and self.pending[key][0] != path:
+                continue  # Superseded by a newer request for the same key
+            self.pending.pop(key, None)
+            completed.append((key, path if success else None))
+        return completed
+
+    def prune(self, images):
+        # Deletes the thumbnails of files, modification times and ROIs no longer in the folder
+        keep = {os.path.basename(path) for path in map(self.path_for, images) if path is not None}
+        for name in os.listdir(self.folder):
+            if name not in keep:
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except OSError:
+                    pass
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
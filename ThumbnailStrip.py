@@ -0,0 +1,164 @@
+import os
+import tkinter as tk
+from PIL import Image, ImageTk
+from ThumbnailCache import THUMBNAIL_SIZE
+
+THUMBNAIL_PADDING = 6
+THUMBNAIL_LABEL_HEIGHT = 14
+POLL_DELAY = 100  # ms between checks for finished thumbnails
+PRELOAD_MARGIN = 10  # Thumbnails requested beyond each side of the visible ones
+KEEP_MARGIN = 100  # Thumbnails further than this from the visible ones are released from memory
+SELECTION_COLOR = "orange"
+
+
+class ThumbnailStrip(tk.Frame):
+    # Horizontally scrolling strip of thumbnails (see ThumbnailCache) of the images of a folder.
+    # Only the visible thumbnails (plus a margin) are requested, loaded and kept in memory, so large
+    # folders scroll without decoding every image. Clicking a thumbnail calls on_select(index).
+    def __init__(self, master, on_select, size = THUMBNAIL_SIZE, **kwargs):
+        super().__init__(master, **kwargs)
+        self.on_select = on_select
+        self.size = size
+        self.cell_width = size + THUMBNAIL_PADDING
+        self.cache = None
+        self.image_instances = []
+        self.photos = {}  # index -> PhotoImage currently shown
+        self.items = {}  # index -> (placeholder, image item or None)
+        self.failed = set()  # Indices whose thumbnail could not be created
+        self.selected = None
+        self.poll_job = None
+
+        self.canvas = tk.Canvas(self, height=size + THUMBNAIL_LABEL_HEIGHT + THUMBNAIL_PADDING, bg="gray20",
+                                highlightthickness=0)
+        scrollbar = tk.Scrollbar(self, orient="horizontal", command=self.on_scroll)
+        self.canvas.config(xscrollcommand=scrollbar.set)
+        self.canvas.pack(side=tk.TOP, fill=tk.X)
+        scrollbar.pack(side=tk.BOTTOM, fill=tk.X)
+        self.selection_item = self.canvas.create_rectangle(0, 0, 0, 0, outline=SELECTION_COLOR, width=3, state=tk.HIDDEN)
+        self.canvas.bind("<Configure>", lambda event: self.load_visible())
+        self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<Shift-MouseWheel>", self.on_mouse_wheel)
+        self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)
+        # X11 reports the wheel as buttons 4 and 5
+        self.canvas.bind("<Button-4>", self.on_mouse_wheel)
+        self.canvas.bind("<Button-5>", self.on_mouse_wheel)
+
+    def set_images(self, cache, image_instances):
+        self.cache = cache
+        self.image_instances = image_instances
+        self.photos.clear()
+        self.items.clear()
+        self.failed.clear()
+        self.selected = None
+        self.canvas.delete("thumbnail")
+        self.canvas.itemconfig(self.selection_item, state=tk.HIDDEN)
+        self.canvas.config(scrollregion=(0, 0, len(image_instances) * self.cell_width, self.size + THUMBNAIL_LABEL_HEIGHT))
+        self.canvas.xview_moveto(0)
+        self.load_visible()
+
+    def visible_range(self):
+        left = self.canvas.canvasx(0)
+        right = self.canvas.canvasx(self.canvas.winfo_width())
+        return int(left // self.cell_width), int(right // self.cell_width)
+
+    def on_scroll(self, *args):
+        self.canvas.xview(*args)
+        self.load_visible()
+
+    def on_mouse_wheel(self, event):
+        self.canvas.xview_scroll(-1 if event.num == 4 or event.delta > 0 else 1, "units")
+        self.load_visible()
+
+    def on_click(self, event):
+        index = int(self.canvas.canvasx(event.x) // self.cell_width)
+        if 0 <= index < len(self.image_instances):
+            self.on_select(index)
+
+    def select(self, index):
+        # Highlights the thumbnail of the selected image and scrolls it into view
+        self.selected = index
+        x = index * self.cell_width
+        self.canvas.coords(self.selection_item, x + 1, 1, x + self.cell_width - 1, self.size + THUMBNAIL_LABEL_HEIGHT)
+        self.canvas.itemconfig(self.selection_item, state=tk.NORMAL)
+        self.canvas.tag_raise(self.selection_item)
+        first, last = self.visible_range()
+        if not first <= index < last and self.image_instances:
+            self.canvas.xview_moveto(max(0, index - (last - first) // 2) / len(self.image_instances))
+        self.load_visible()
+
+    def refresh(self, index):
+        # The file or ROIs of an image changed, request its thumbnail again
+        self.canvas.delete(f"thumbnail_{index}")
+        self.items.pop(index, None)
+        self.photos.pop(index, None)
+        self.failed.discard(index)
+        self.load_visible()
+
+    def load_visible(self):
+        if self.cache is None or not self.image_instances:
+            return
+        first, last = self.visible_range()
+        first, last = max(0, first - PRELOAD_MARGIN), min(len(self.image_instances), last + PRELOAD_MARGIN + 1)
+        wanted = {index: self.image_instances[index] for index in range(first, last)
+                  if index not in self.photos and index not in self.failed}
+        for index in wanted:
+            self.draw_placeholder(index)
+        for index, path in self.cache.request(wanted).items():
+            self.show(index, path)
+        # Release thumbnails (and placeholders of thumbnails never shown) far outside the view
+        for index in [index for index in self.items if not first - KEEP_MARGIN <= index < last + KEEP_MARGIN]:
+            self.canvas.delete(f"thumbnail_{index}")
+            self.photos.pop(index, None)
+            del self.items[index]
+        if self.cache.pending and self.poll_job is None:
+            self.poll_job = self.after(POLL_DELAY, self.poll)
+
+    def poll(self):
+        self.poll_job = None
+        if self.cache is None:
+            return
+        first, last = self.visible_range()
+        for index, path in self.cache.poll():
+            if path is None:
+                self.failed.add(index)
+            elif first - KEEP_MARGIN <= index < last + KEEP_MARGIN and index < len(self.image_instances):
+                self.show(index, path)
+        if self.cache.pending:
+            self.poll_job = self.after(POLL_DELAY, self.poll)
+
+    def draw_placeholder(self, index):
+        if index in self.items:
+            return
+        x = index * self.cell_width + THUMBNAIL_PADDING // 2
+        tags = ("thumbnail", f"thumbnail_{index}")
+        placeholder = self.canvas.create_rectangle(x, THUMBNAIL_PADDING // 2, x + self.size, self.size,
+                                                   fill="gray30", outline="", tags=tags)
+        self.canvas.create_text(x + self.size // 2, self.size + THUMBNAIL_LABEL_HEIGHT // 2,
+                                text=os.path.basename(self.image_instances[index].file_name)[:24],
+                                fill="white", font=("Arial", 8), tags=tags)
+        self.items[index] = (placeholder, None)
+
+    def show(self, index, path):
+        try:
+            with Image.open(path) as image:
+                photo = ImageTk.PhotoImage(image)
+        except OSError:
+            self.failed.add(index)
+            return
+        self.draw_placeholder(index)
+        placeholder, image_item = self.items[index]
+        x = index * self.cell_width + THUMBNAIL_PADDING // 2
+        if image_item is None:
+            image_item = self.canvas.create_image(x + self.size // 2, self.size // 2 + THUMBNAIL_PADDING // 2,
+                                                  image=photo, tags=("thumbnail", f"thumbnail_{index}"))
+        else:
+            self.canvas.itemconfig(image_item, image=photo)
+        self.items[index] = (placeholder, image_item)
+        self.photos[index] = photo
+        self.canvas.tag_raise(self.selection_item)
+
+    def close(self):
+        if self.poll_job is not None:
+            self.after_cancel(self.poll_job)
+            self.poll_job = None
+        self.cache = None